@@ -2,6 +2,9 @@
 # copyright notices and license terms.
 from trytond.pool import Pool
 from . import edi_shipment
+from . import import_run
+from . import party
+from . import product
 from . import shipment
 
 
@@ -14,5 +17,8 @@ def register():
         edi_shipment.EdiShipmentIn,
         edi_shipment.EdiShipmentInLineQty,
         edi_shipment.StockConfiguration,
+        import_run.EdiShipmentInImportRun,
+        party.PartyIdentifier,
+        product.ProductIdentifier,
         shipment.ShipmentIn,
         module='stock_shipment_in_edi', type_='model')
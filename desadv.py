@@ -0,0 +1,462 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''Parser of DESADV files
+
+It does not depend on the database so the files can be parsed in worker
+processes. The parsed messages are converted to EDI shipments when saved.
+'''
+import hashlib
+import os
+import yaml
+from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
+from stdnum import ean
+
+MODULE_PATH = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE = os.path.join(MODULE_PATH, 'templates', 'DESADV_ediversa.yml')
+SHORT_DATE_FORMAT = '%y%m%d'
+DATE_FORMAT = '%Y%m%d'
+CONVERSION_CACHE_SIZE = 4096
+
+
+class UnknownSegmentError(ValueError):
+    'Raised when a segment has no reader'
+
+    def __init__(self, segment):
+        super().__init__(segment)
+        self.segment = segment
+
+
+@lru_cache(maxsize=CONVERSION_CACHE_SIZE)
+def to_date(value):
+    if value is None or value == '':
+        return None
+    if len(value) > 8:
+        value = value[0:8]
+    if value == '00000000':
+        return
+    if value.isdigit():
+        # Slicing is much faster than strptime for the fixed-width formats
+        if len(value) == 6:
+            year = int(value[0:2])
+            # Same pivot as strptime %y
+            year += 1900 if year >= 69 else 2000
+            return datetime(year, int(value[2:4]), int(value[4:6]))
+        elif len(value) == 8:
+            return datetime(
+                int(value[0:4]), int(value[4:6]), int(value[6:8]))
+    if len(value) == 6:
+        return datetime.strptime(value, SHORT_DATE_FORMAT)
+    return datetime.strptime(value, DATE_FORMAT)
+
+
+@lru_cache(maxsize=None)
+def _quantizer(digits):
+    return Decimal('10')**-digits
+
+
+@lru_cache(maxsize=CONVERSION_CACHE_SIZE)
+def to_decimal(value, digits=2):
+    if value is None or value == '':
+        return None
+    return Decimal(value).quantize(_quantizer(digits))
+
+
+@lru_cache()
+def load_template(filename=TEMPLATE):
+    '''Return the document type and the data separator of a template
+
+    The template is only read once per process.
+    '''
+    with open(filename, encoding='utf-8') as fp:
+        template = yaml.load(fp, Loader=yaml.FullLoader)
+    document_type = next(iter(template['header']))
+    separator = template['control_chars']['data_separator']
+    return document_type, separator
+
+
+def read_segments(lines, separator='|'):
+    '''Yield (segment id, values) for every line of an EDI file
+
+    Lines are consumed lazily so a file handle can be passed directly and
+    the whole file is never held in memory.
+    '''
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        values = line.split(separator)
+        yield values.pop(0), values
+
+
+class Record:
+    '''Base class of the parsed records
+
+    The records are extended by subclassing them, the segments are read by
+    their read_<segment id> methods and the new values must be declared in
+    __slots__.
+    '''
+    __slots__ = ()
+    _children = ()
+    # Values that are not stored
+    _internal = ()
+    # The slots of the class and of its parents
+    _names = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._names = tuple(n for c in reversed(cls.__mro__)
+            for n in c.__dict__.get('__slots__', ()))
+
+    def __init__(self):
+        for name in self._names:
+            setattr(self, name, [] if name in self._children else None)
+
+    def values(self):
+        'Return the values that are set without the children'
+        return {n: getattr(self, n) for n in self._names
+            if n not in self._children and n not in self._internal
+            and getattr(self, n) is not None}
+
+
+class Supplier(Record):
+    'Parsed NAD segment'
+    __slots__ = ('type_', 'edi_code')
+
+    def read_NADMS(self, message):
+        self.type_ = 'NADMS'
+        self.edi_code = message.pop(0) if message else ''
+
+    def read_NADBY(self, message):
+        self.type_ = 'NADBY'
+        self.edi_code = message.pop(0) if message else ''
+
+    def read_NADSU(self, message):
+        self.type_ = 'NADSU'
+        self.edi_code = message.pop(0) if message else ''
+
+    def read_NADDP(self, message):
+        self.type_ = 'NADDP'
+        self.edi_code = message.pop(0) if message else ''
+
+
+class Reference(Record):
+    'Parsed RFF or RFFLIN segment'
+    __slots__ = ('type_', 'reference', 'reference_date', 'origin')
+
+
+class Quantity(Record):
+    'Parsed QTYLIN or QVRLIN segment'
+    __slots__ = ('type_', 'quantity', 'unit', 'difference')
+
+
+class Line(Record):
+    'Parsed LIN segment and its details'
+    __slots__ = ('code', 'code_type', 'line_number', 'purchaser_code',
+        'supplier_code', 'serial_number', 'lot_number', 'description_type',
+        'description', 'desccod', 'dimension', 'dimension_unit',
+        'dimension_qualifier', 'dimension_min', 'dimension_max',
+        'marking_instructions', 'expiration_date', 'packing_date',
+        'planned_date', 'quantity', 'unit', 'free_quantity', 'quantities',
+        'references')
+    _children = ('quantities', 'references')
+
+    def read_LIN(self, message):
+        def _get_code_type(code):
+            # stdnum.ena only handles numbers EAN-13, EAN-8, UPC (12-digit)
+            # and GTIN (EAN-14) format
+            if ean.is_valid(code):
+                return 'EAN%s' % str(len(code))
+            # TODO DUN14
+            return None
+
+        self.code = message.pop(0) if message else ''
+        code_type = message.pop(0) if message else ''
+        if code_type == 'EN':
+            # Some times the provider send the EAN13 without left zeros
+            # and the EAN is an EAN13 but the check fail because it have
+            # less digits.
+            code = (self.code.zfill(13) if len(self.code) < 13 and
+                len(self.code) != 8 else self.code)
+            self.code_type = _get_code_type(code)
+            if self.code_type:
+                self.code = code
+        self.line_number = message.pop(0) if message else ''
+
+    def read_PIALIN(self, message):
+        self.purchaser_code = message.pop(0) if message else ''
+        if message:
+            self.supplier_code = message.pop(0)
+        if message:
+            message.pop(0)
+        if message:
+            message.pop(0)
+        if message:
+            message.pop(0)
+        if message:
+            message.pop(0)
+        if message:
+            self.serial_number = message.pop(0)
+        if message:
+            message.pop(0)
+        if message:
+            self.lot_number = message.pop(0)
+
+    def read_IMDLIN(self, message):
+        self.description_type = message.pop(0) if message else ''
+        self.description = message.pop(0) if message else ''
+        if self.description_type == 'C' and message:
+            self.desccod = message.pop(0)
+
+    def read_MEALIN(self, message):
+        self.dimension = message.pop(0) if message else ''
+        if message:
+            self.dimension_unit = message.pop(0)
+        if message:
+            self.dimension_qualifier = message.pop(0)
+        if message:
+            self.dimension_min = message.pop(0)
+        if message:
+            self.dimension_max = message.pop(0)
+
+    def read_QTYLIN(self, message):
+        qty = Quantity()
+        qty.type_ = message.pop(0) if message else ''
+        qty.quantity = to_decimal(message.pop(0), 4) if message else Decimal(0)
+        if message:
+            qty.unit = message.pop(0)
+
+        if qty.type_ == '12' and self.quantity is None:
+            self.quantity = qty.quantity
+            self.unit = qty.unit
+        elif qty.type_ == '192' and self.free_quantity is None:
+            self.free_quantity = qty.quantity
+        self.quantities.append(qty)
+
+    def read_RFFLIN(self, message):
+        ref = Reference()
+        ref.type_ = message.pop(0) if message else ''
+        ref.reference = message.pop(0) if message else ''
+        self.references.append(ref)
+
+    def read_PCILIN(self, message):
+        marking_instructions = message.pop(0) if message else ''
+        if marking_instructions != '36E':
+            return
+        self.marking_instructions = marking_instructions
+        if message:
+            self.expiration_date = to_date(message.pop(0))
+        if message:
+            expiration_date = to_date(message.pop(0))
+            if (not self.expiration_date and expiration_date and
+                    expiration_date > datetime.today()):
+                self.expiration_date = expiration_date
+        if message:
+            message.pop(0)
+        if message:
+            self.packing_date = to_date(message.pop(0))
+        if message:
+            message.pop(0)
+        if message:
+            message.pop(0)
+        if message:
+            self.lot_number = message.pop(0)
+
+    def read_QVRLIN(self, message):
+        qty = Quantity()
+        qty.type_ = message.pop(0) if message else ''
+        qty.quantity = to_decimal(message.pop(0), 4) if message else Decimal(0)
+        qty.difference = message.pop(0) if message else ''
+        self.quantities.append(qty)
+
+    def read_DTMLIN(self, message):
+        if message:
+            self.planned_date = to_date(message.pop(0))
+
+    def read_MOALIN(self, message):
+        # Not implemented
+        pass
+
+    def read_FTXLIN(self, message):
+        # Not implemented
+        pass
+
+    def read_LOCLIN(self, message):
+        # Not implemented
+        pass
+
+
+class Message(Record):
+    'Parsed DESADV message'
+    __slots__ = ('number', 'type_', 'function_', 'expedition_date',
+        'estimated_date', 'message_hash', 'supplier_edi_code', 'duplicate',
+        'lines', 'references', 'suppliers', 'segments')
+    _children = ('lines', 'references', 'suppliers')
+    _internal = ('segments',)
+
+    def read_BGM(self, message):
+        self.number = message.pop(0) if message else ''
+        self.type_ = message.pop(0) if message else ''
+        self.function_ = message.pop(0) if message else ''
+
+    def read_DTM(self, message):
+        if message:
+            self.expedition_date = to_date(message.pop(0))
+        if message:
+            self.estimated_date = to_date(message.pop(0))
+
+    def read_RFF(self, message):
+        ref = Reference()
+        type_ = message.pop(0) if message else ''
+
+        ref.type_ = type_ if type_ in ('DQ', 'ON', 'LI', 'VN') else None
+
+        if message:
+            ref.reference = message.pop(0)
+        if message:
+            ref.reference_date = to_date(message.pop(0))
+        self.references.append(ref)
+
+    def read_TOD(self, message):
+        # Not implemented
+        pass
+
+    def read_TDT(self, message):
+        # Not implemented
+        pass
+
+    def read_CPS(self, message):
+        # Not implemented
+        pass
+
+    def read_PAC(self, message):
+        # Not implemented
+        pass
+
+    def read_HAN(self, message):
+        # Not implemented
+        pass
+
+    def read_PCI(self, message):
+        # Not implemented
+        pass
+
+    def read_ALI(self, message):
+        # Not implemented
+        pass
+
+    def read_CNTRES(self, message):
+        # Not implemented
+        pass
+
+    def read_MOA(self, message):
+        # Not implemented
+        pass
+
+    def read_MEA(self, message):
+        # Not implemented
+        pass
+
+
+DEFAULT_CLASSES = (Message, Line, Supplier)
+
+
+@lru_cache()
+def get_segment_dispatch(classes=DEFAULT_CLASSES):
+    '''Return a dict mapping every known segment id to its reader
+
+    classes is the tuple of the message, line and supplier classes.
+    The value is a (target, handler name) tuple where target is one of:
+    message, shipment, line, line_detail or supplier.
+    '''
+    Message, Line, Supplier = classes
+
+    def readers(Class):
+        for name in dir(Class):
+            if name.startswith('read_'):
+                yield name[5:], name
+
+    dispatch = {}
+    for msg_id, handler in readers(Message):
+        dispatch[msg_id] = ('shipment', handler)
+    for msg_id, handler in readers(Line):
+        dispatch[msg_id] = ('line_detail', handler)
+    for msg_id, handler in readers(Supplier):
+        dispatch[msg_id] = ('supplier', handler)
+    dispatch['BGM'] = ('message', 'read_BGM')
+    dispatch['LIN'] = ('line', 'read_LIN')
+    return dispatch
+
+
+def parse(data, template=TEMPLATE, classes=DEFAULT_CLASSES):
+    '''Return the messages of the DESADV lines
+
+    The records are instances of classes, the tuple of the message, line and
+    supplier classes. An empty list is returned if the document type is not
+    the one of the template.
+    '''
+    document_type, separator = load_template(template)
+    dispatch = get_segment_dispatch(classes)
+    Message, Line, Supplier = classes
+
+    messages = []
+    message = line = None
+    digest = None
+    segments = 0
+    data = iter(data)
+    if next(data, '').rstrip('\r\n') != document_type:
+        return messages
+    for msg_id, values in read_segments(data, separator):
+        if msg_id == document_type:
+            # Batched files repeat the document header for each message
+            continue
+        if msg_id == 'BGM':
+            if message:
+                message.message_hash = digest.hexdigest()
+                message.segments = segments
+            digest = hashlib.sha256()
+            segments = 0
+            # The function is not hashed so a copy matches the original
+            normalized = [msg_id] + [v.strip() for v in values[:2]]
+        else:
+            normalized = [msg_id] + [v.strip() for v in values]
+        if digest:
+            segments += 1
+            digest.update(
+                separator.join(normalized).encode('utf-8') + b'\n')
+
+        target, handler = dispatch.get(msg_id, (None, None))
+        if target == 'line_detail':
+            getattr(line, handler)(values)
+        elif target == 'message':
+            message = Message()
+            getattr(message, handler)(values)
+            messages.append(message)
+        elif target == 'line':
+            line = Line()
+            getattr(line, handler)(values)
+            message.lines.append(line)
+        elif target == 'shipment':
+            getattr(message, handler)(values)
+        elif target == 'supplier':
+            supplier = Supplier()
+            getattr(supplier, handler)(values)
+            message.suppliers.append(supplier)
+            if (supplier.type_ == 'NADSU'
+                    and message.supplier_edi_code is None):
+                message.supplier_edi_code = supplier.edi_code
+        else:
+            if msg_id.startswith('NAD'):
+                continue
+            raise UnknownSegmentError(msg_id)
+    if message:
+        message.message_hash = digest.hexdigest()
+        message.segments = segments
+    return messages
+
+
+def parse_file(filename, encoding='latin-1', classes=DEFAULT_CLASSES):
+    'Return the messages of the DESADV file'
+    with open(filename, 'r', encoding=encoding) as fp:
+        return parse(fp, classes=classes)
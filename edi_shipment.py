@@ -1,40 +1,115 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from trytond.model import fields, ModelSQL, ModelView, Workflow
+from sql import Literal, Select
+from sql.conditionals import Coalesce
+from sql.operators import Equal
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import (fields, ModelSQL, ModelView, Workflow, Exclude,
+    Index)
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
+import base64
+import cProfile
+import gzip
+import json
+import logging
+import multiprocessing
 import os
-from trytond.modules.party_edi.party import SupplierEdiMixin, SUPPLIER_TYPE
+import re
+import time
+import traceback
+import uuid
+import zlib
+from collections import defaultdict
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from trytond.modules.party_edi.party import SupplierEdiMixin
 from datetime import datetime
-from decimal import Decimal
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 from trytond.pyson import Eval
-from stdnum import ean
+from trytond.tools import grouped_slice
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
 
-DEFAULT_FILES_LOCATION = '/tmp/'
-MODULE_PATH = os.path.dirname(os.path.abspath(__file__))
-KNOWN_EXTENSIONS = ['.txt', '.edi', '.pla']
-SHORT_DATE_FORMAT = '%y%m%d'
-DATE_FORMAT = '%Y%m%d'
-
-
-def to_date(value):
-    if value is None or value == '':
-        return None
-    if len(value) > 8:
-        value = value[0:8]
-    if value == '00000000':
-        return
-    if len(value) == 6:
-        return datetime.strptime(value, SHORT_DATE_FORMAT)
-    return datetime.strptime(value, DATE_FORMAT)
+from . import desadv
+from .import_run import ImportStats
 
+logger = logging.getLogger(__name__)
 
-def to_decimal(value, digits=2):
-    if value is None or value == '':
-        return None
-    return Decimal(value).quantize(Decimal('10')**-digits)
+DEFAULT_FILES_LOCATION = '/tmp/'
+PROCESSING_DIRECTORY = 'processing'
+ARCHIVE_DIRECTORY = 'archive'
+ERROR_DIRECTORY = 'error'
+IMPORT_LOCK_ID = zlib.crc32(b'edi.shipment.in|import_shipment_in')
+KNOWN_EXTENSIONS = ['.txt', '.edi', '.pla']
+CLAIMED_PREFIX = re.compile(r'^\d{14}-[0-9a-f]{8}-')
+UNITS = [
+    (None, ''),
+    ('KGM', 'Kilogramo'),
+    ('GRM', 'Gramo'),
+    ('LTR', 'Litro'),
+    ('PCE', 'Pieza'),
+    ('EA', 'EA'),
+    ]
+REFERENCE_MODELS = {
+    'DQ': 'stock.shipment.in',
+    'ON': 'purchase.purchase',
+    }
+CACHE_SIZE = config.getint('stock_shipment_in_edi', 'cache_size',
+    default=10240)
+CACHE_DURATION = config.getint('stock_shipment_in_edi', 'cache_duration',
+    default=60 * 60)
+IMPORT_WORKERS = config.getint('stock_shipment_in_edi', 'import_workers',
+    default=1)
+IMPORT_CHUNK_SIZE = config.getint('stock_shipment_in_edi',
+    'import_chunk_size', default=1)
+IMPORT_SETTLE_TIME = config.getfloat('stock_shipment_in_edi',
+    'import_settle_time', default=1)
+PARSE_PROCESSES = config.getint('stock_shipment_in_edi', 'parse_processes',
+    default=0)
+PROFILE_DIRECTORY = config.get('stock_shipment_in_edi', 'profile_directory')
+PROCESS_BATCH_SIZE = config.getint('stock_shipment_in_edi',
+    'process_batch_size', default=100)
+PURGE_BATCH_SIZE = config.getint('stock_shipment_in_edi', 'purge_batch_size',
+    default=1000)
+WATCH_DELAY = config.getfloat('stock_shipment_in_edi', 'watch_delay',
+    default=2)
+WATCH_CONFIGURATION_DELAY = config.getfloat('stock_shipment_in_edi',
+    'watch_configuration_delay', default=60)
+
+
+def claimed_name(name):
+    '''Return a unique name for the claimed file
+
+    Suppliers may reuse the same file name, so the name is prefixed to not
+    overwrite a file not yet imported or already archived.
+    '''
+    return '%s-%s-%s' % (datetime.now().strftime('%Y%m%d%H%M%S'),
+        uuid.uuid4().hex[:8], name)
+
+
+def original_name(filename):
+    'Return the name of the file before it was claimed'
+    return CLAIMED_PREFIX.sub('', os.path.basename(filename), count=1)
+
+
+_parse_executor = None
+
+
+def get_parse_executor():
+    'Return the process pool used to parse the files'
+    global _parse_executor
+    if _parse_executor is None:
+        # spawn is used as the server process may have threads
+        _parse_executor = ProcessPoolExecutor(max_workers=PARSE_PROCESSES,
+            mp_context=multiprocessing.get_context('spawn'))
+    return _parse_executor
 
 
 class Cron(metaclass=PoolMeta):
@@ -45,36 +120,86 @@ class Cron(metaclass=PoolMeta):
         super(Cron, cls).__setup__()
         cls.method.selection.extend([
             ('edi.shipment.in|import_shipment_in',
-            'Import EDI Shipment In Orders')])
+            'Import EDI Shipment In Orders'),
+            ('edi.shipment.in|purge_edi_shipments',
+            'Purge Old EDI Shipment In'),
+            ])
 
 
 class StockConfiguration(metaclass=PoolMeta):
     __name__ = 'stock.configuration'
 
     inbox_path_edi = fields.Char('EDI Shipment Inbox Path')
+    edi_shipment_duplicate = fields.Selection([
+            ('skip', 'Skip'),
+            ('replace', 'Replace'),
+            ('flag', 'Flag'),
+            ], 'EDI Shipment Duplicates',
+        help='What to do with the EDI shipments already imported.')
+    edi_shipment_auto_process = fields.Boolean(
+        'Process EDI Shipments Automatically',
+        help='Create and confirm the shipment of the imported EDI shipments '
+        'that are fully matched.')
+    edi_shipment_retention = fields.TimeDelta('EDI Shipment Retention',
+        help='The delay after which the confirmed and cancelled EDI '
+        'shipments are purged.\n'
+        'Leave empty to keep them.')
+    edi_shipment_archive_path = fields.Char('EDI Shipment Archive Path',
+        help='The directory where the EDI shipments are exported before '
+        'being purged.\n'
+        'Leave empty to not export them.')
+
+    @staticmethod
+    def default_edi_shipment_duplicate():
+        return 'skip'
 
 
 class SupplierEdi(SupplierEdiMixin, ModelSQL, ModelView):
     'EDI Supplier'
     __name__ = 'edi.shipment.supplier'
 
-    edi_shipment = fields.Many2One('edi.shipment.in', 'EDI Shipment')
+    edi_shipment = fields.Many2One('edi.shipment.in', 'EDI Shipment',
+        ondelete='CASCADE')
+    _party_cache = Cache('edi.shipment.supplier.search_party',
+        size_limit=CACHE_SIZE, duration=CACHE_DURATION, context=False)
 
-    def read_NADMS(self, message):
-        self.type_ = 'NADMS'
-        self.edi_code = message.pop(0) if message else ''
+    def search_party(self):
+        key = (self.type_, self.edi_code)
+        party_id = self._party_cache.get(key, -1)
+        if party_id != -1:
+            self.party = party_id
+            return
+        super().search_party()
+        party = getattr(self, 'party', None)
+        self._party_cache.set(key, party.id if party else None)
 
-    def read_NADBY(self, message):
-        self.type_ = 'NADBY'
-        self.edi_code = message.pop(0) if message else ''
+    @classmethod
+    def update_edi_shipment_party(cls, edi_shipment_ids):
+        'Update the party stored on the EDI shipments'
+        pool = Pool()
+        EdiShipmentIn = pool.get('edi.shipment.in')
 
-    def read_NADSU(self, message):
-        self.type_ = 'NADSU'
-        self.edi_code = message.pop(0) if message else ''
+        if edi_shipment_ids:
+            EdiShipmentIn.update_party(
+                EdiShipmentIn.browse(list(edi_shipment_ids)))
 
-    def read_NADDP(self, message):
-        self.type_ = 'NADDP'
-        self.edi_code = message.pop(0) if message else ''
+    @classmethod
+    def create(cls, vlist):
+        suppliers = super().create(vlist)
+        cls.update_edi_shipment_party(
+            {s.edi_shipment.id for s in suppliers if s.edi_shipment})
+        return suppliers
+
+    @classmethod
+    def write(cls, *args):
+        suppliers = sum(args[0:None:2], [])
+        # A supplier moved to another EDI shipment changes both parties
+        edi_shipment_ids = {s.edi_shipment.id for s in suppliers
+            if s.edi_shipment}
+        super().write(*args)
+        edi_shipment_ids.update(s.edi_shipment.id
+            for s in cls.browse(suppliers) if s.edi_shipment)
+        cls.update_edi_shipment_party(edi_shipment_ids)
 
 
 class EdiShipmentReference(ModelSQL, ModelView):
@@ -93,9 +218,18 @@ class EdiShipmentReference(ModelSQL, ModelView):
     reference_date = fields.Date('Reference Date', readonly=True)
     origin = fields.Reference('Reference', selection='get_resource')
     edi_shipment_in_line = fields.Many2One('edi.shipment.in.line',
-        'Line', readonly=True)
+        'Line', readonly=True, ondelete='CASCADE')
     edi_shipment = fields.Many2One('edi.shipment.in',
-        'Shipment', readonly=True)
+        'Shipment', readonly=True, ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.reference, Index.Equality()),
+                (t.type_, Index.Equality())))
 
     @classmethod
     def get_resource(cls):
@@ -115,17 +249,38 @@ class EdiShipmentReference(ModelSQL, ModelView):
         self.value = value
 
     def search_reference(self):
-        model = None
-        if self.type_ == 'DQ':
-            model = 'stock.shipment.in'
-        elif self.type_ == 'ON':
-            model = 'purchase.purchase'
-        if not model:
-            return
+        self.search_origins([self])
+
+    @classmethod
+    def search_origins(cls, references):
+        '''Set the origin of the references from their number
+
+        A single search is done per target model for all the references.
+        The references whose number is not found are left untouched.
+        '''
+        pool = Pool()
 
-        Model = Pool().get(model)
-        res = Model.search([('number', '=', self.reference)], limit=1)
-        self.origin = res[0] if res else None
+        numbers = defaultdict(set)
+        for reference in references:
+            model = REFERENCE_MODELS.get(reference.type_)
+            if model and reference.reference:
+                numbers[model].add(reference.reference)
+
+        origins = {}
+        for model, model_numbers in numbers.items():
+            Model = pool.get(model)
+            for sub_numbers in grouped_slice(model_numbers):
+                for record in Model.search([
+                            ('number', 'in', list(sub_numbers)),
+                            ]):
+                    origins.setdefault((model, record.number), record)
+
+        for reference in references:
+            model = REFERENCE_MODELS.get(reference.type_)
+            origin = origins.get((model, reference.reference))
+            # Keep the origin set by the user if the number is not found
+            if origin:
+                reference.origin = origin
 
 # class EdiShipmentInTransport(ModelSQL, ModelView):
 #     'EDI Shipment in Transport'
@@ -230,176 +385,144 @@ class EdiShipmentInLine(ModelSQL, ModelView):
     references = fields.One2Many('edi.shipment.in.reference',
         'edi_shipment_in_line', 'References')
     edi_shipment = fields.Many2One('edi.shipment.in', 'Shipment',
-        readonly=True)
+        readonly=True, ondelete='CASCADE')
     product = fields.Many2One('product.product', 'Product')
-    quantity = fields.Function(fields.Numeric('Quantity', digits=(16, 4)),
-        'shipment_quantity')
-
-    def shipment_quantity(self, name):
-        for q in self.quantities:
-            if q.type_ == '12':
-                return q.quantity
-        return Decimal('0')
-
-    def read_LIN(self, message):
-        def _get_code_type(code):
-            # stdnum.ena only handles numbers EAN-13, EAN-8, UPC (12-digit)
-            # and GTIN (EAN-14) format
-            if ean.is_valid(code):
-                return 'EAN%s' % str(len(code))
-            # TODO DUN14
-            return None
-
-        self.code = message.pop(0) if message else ''
-        code_type = message.pop(0) if message else ''
-        if code_type == 'EN':
-            # Some times the provider send the EAN13 without left zeros
-            # and the EAN is an EAN13 but the check fail because it have
-            # less digits.
-            code = (self.code.zfill(13) if len(self.code) < 13 and
-                len(self.code) != 8 else self.code)
-            self.code_type = _get_code_type(code)
-            if self.code_type:
-                self.code = code
-        self.line_number = message.pop(0) if message else ''
-
-    def read_PIALIN(self, message):
-        self.purchaser_code = message.pop(0) if message else ''
-        if message:
-            self.supplier_code = message.pop(0)
-        if message:
-            message.pop(0)
-        if message:
-            message.pop(0)
-        if message:
-            message.pop(0)
-        if message:
-            message.pop(0)
-        if message:
-            self.serial_number = message.pop(0)
-        if message:
-            message.pop(0)
-        if message:
-            self.lot_number = message.pop(0)
-
-    def read_IMDLIN(self, message):
-        self.description_type = message.pop(0) if message else ''
-        self.description = message.pop(0) if message else ''
-        if self.description_type == 'C' and message:
-            self.desccod = message.pop(0)
-
-    def read_MEALIN(self, message):
-        self.dimension = message.pop(0) if message else ''
-        if message:
-            self.dimension_unit = message.pop(0)
-        if message:
-            self.dimension_qualifier = message.pop(0)
-        if message:
-            self.dimension_min = message.pop(0)
-        if message:
-            self.dimension_max = message.pop(0)
-
-    def read_QTYLIN(self, message):
-        pool = Pool()
-        QTY = pool.get('edi.shipment.in.line.qty')
-
-        qty = QTY()
-        qty.type_ = message.pop(0) if message else ''
-        qty.quantity = to_decimal(message.pop(0), 4) if message else Decimal(0)
-        if message:
-            qty.unit = message.pop(0)
-
-        if not getattr(self, 'quantities', False):
-            self.quantities = []
-        self.quantities += (qty, )
-
-    def read_RFFLIN(self, message):
-        pool = Pool()
-        REF = pool.get('edi.shipment.in.reference')
+    quantity = fields.Numeric('Quantity', digits=(16, 4), readonly=True)
+    unit = fields.Selection(UNITS, 'Unit', readonly=True)
+    free_quantity = fields.Numeric('Free Quantity', digits=(16, 4),
+        readonly=True)
+    _product_cache = Cache('edi.shipment.in.line.search_products',
+        size_limit=CACHE_SIZE, duration=CACHE_DURATION, context=False)
 
-        ref = REF()
-        ref.type_ = message.pop(0) if message else ''
-        ref.reference = message.pop(0) if message else ''
-        ref.search_reference()
-        if not getattr(self, 'references', False):
-            self.references = []
-        self.references += (ref,)
-
-    def read_PCILIN(self, message):
-        marking_instructions = message.pop(0) if message else ''
-        if marking_instructions != '36E':
-            return
-        self.marking_instructions = marking_instructions
-        if message:
-            self.expiration_date = to_date(message.pop(0))
-        if message:
-            expiration_date = to_date(message.pop(0))
-            if (not self.expiration_date and expiration_date and
-                    expiration_date > datetime.today()):
-                self.expiration_date = expiration_date
-        if message:
-            message.pop(0)
-        if message:
-            self.packing_date = to_date(message.pop(0))
-        if message:
-            message.pop(0)
-        if message:
-            message.pop(0)
-        if message:
-            self.lot_number = message.pop(0)
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.code, Index.Equality())))
 
-    def read_QVRLIN(self, message):
+    @classmethod
+    def __register__(cls, module_name):
         pool = Pool()
         QTY = pool.get('edi.shipment.in.line.qty')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        qty = QTY.__table__()
+        # The table handler creates the table
+        table_exists = backend.TableHandler.table_exist(cls._table)
+        table_h = cls.__table_handler__(module_name)
+        quantity_exists = table_h.column_exist('quantity')
+
+        super().__register__(module_name)
+
+        # Migration from 6.4: quantities are stored on the line
+        if (table_exists and not quantity_exists
+                and backend.TableHandler.table_exist(QTY._table)):
+            def select(column, type_):
+                return qty.select(column,
+                    where=(qty.edi_shipment_line == table.id)
+                    & (qty.type_ == type_),
+                    order_by=[qty.id.asc],
+                    limit=1)
+            cursor.execute(*table.update(
+                    [table.quantity, table.unit, table.free_quantity],
+                    [select(qty.quantity, '12'), select(qty.unit, '12'),
+                        select(qty.quantity, '192')]))
 
-        qty = QTY()
-        qty.type_ = message.pop(0) if message else ''
-        qty.quantity = to_decimal(message.pop(0), 4) if message else Decimal(0)
-        qty.difference = message.pop(0) if message else ''
-        if not getattr(self, 'quantities', False):
-            self.quantities = []
-        self.quantities += (qty, )
-
-    def read_DTMLIN(self, message):
-        if message:
-            self.planned_date = to_date(message.pop(0))
-
-    def read_MOALIN(self, message):
-        # Not implemented
-        pass
-
-    def read_FTXLIN(self, message):
-        # Not implemented
-        pass
-
-    def read_LOCLIN(self, message):
-        # Not implemented
-        pass
-
-    def search_related(self, edi_shipment):
+    @classmethod
+    def search_products(cls, lines):
+        '''Set the product of the lines from their code
+
+        The codes of all the lines are searched at once on the product
+        identifiers, then on the product codes and finally the supplier code
+        on the product suppliers of the EDI shipment party. Lines without
+        match are left untouched. The product identifier matches are kept in
+        a cache.
+        '''
         pool = Pool()
         ProductIdentifier = pool.get('product.identifier')
+        Product = pool.get('product.product')
+        ProductSupplier = pool.get('purchase.product_supplier')
+
+        products = {}
+        codes = set()
+        for code in {l.code for l in lines if l.code}:
+            product_id = cls._product_cache.get(code, -1)
+            if product_id == -1:
+                codes.add(code)
+            elif product_id is not None:
+                products[code] = product_id
+
+        for sub_codes in grouped_slice(codes):
+            for identifier in ProductIdentifier.search([
+                        ('code', 'in', list(sub_codes)),
+                        ]):
+                products.setdefault(identifier.code, identifier.product.id)
+        for code in codes:
+            cls._product_cache.set(code, products.get(code))
+
+        codes = {l.code for l in lines if l.code} - set(products)
+        for sub_codes in grouped_slice(codes):
+            for product in Product.search([
+                        ('code', 'in', list(sub_codes)),
+                        ]):
+                products.setdefault(product.code, product.id)
+
+        def party(line):
+            edi_shipment = getattr(line, 'edi_shipment', None)
+            if edi_shipment and edi_shipment.party:
+                return edi_shipment.party.id
+
+        # The supplier code is the article number of the supplier so it is
+        # only searched on the product suppliers of the same party
+        supplier_products = {}
+        supplier_codes = defaultdict(set)
+        for line in lines:
+            if (line.supplier_code and line.code not in products
+                    and party(line)):
+                supplier_codes[party(line)].add(line.supplier_code)
+        for party_id, party_codes in supplier_codes.items():
+            for sub_codes in grouped_slice(party_codes):
+                for product_supplier in ProductSupplier.search([
+                            ('party', '=', party_id),
+                            ('code', 'in', list(sub_codes)),
+                            ]):
+                    product = product_supplier.product
+                    template = product_supplier.template
+                    if not product and len(template.products) == 1:
+                        product, = template.products
+                    if product:
+                        supplier_products.setdefault(
+                            (party_id, product_supplier.code), product.id)
+
+        for line in lines:
+            product = products.get(line.code)
+            if not product and line.supplier_code:
+                product = supplier_products.get(
+                    (party(line), line.supplier_code))
+            if product:
+                line.product = product
+
+    def search_related(self, edi_shipment, product_moves=None):
+        '''Set the product and the purchase moves of the line
+
+        product_moves is the result of edi_shipment.get_product_moves(), it
+        should be given when matching several lines of the same shipment.
+        '''
+        pool = Pool()
         REF = pool.get('edi.shipment.in.reference')
-        Purchase = pool.get('purchase.purchase')
 
-        domain = [('code', '=', self.code)]
-        codes = ProductIdentifier.search(domain, limit=1)
-        if not codes:
+        if product_moves is None:
+            self.search_products([self])
+            product_moves = edi_shipment.get_product_moves()
+        if not getattr(self, 'product', None):
             return
-        product = codes[0].product
-        self.product = product
-
-        purchases = [x.origin for x in edi_shipment.references if
-            x.type_ == 'ON' and isinstance(x.origin, Purchase)]
 
         self.references = []
-        for purchase in purchases:
-            for move in purchase.moves:
-                if move.product == product:
-                    ref = REF()
-                    ref.type_ = 'ON'
-                    ref.origin = 'stock.move,%s ' % move.id
-                    self.references += (ref,)
+        for move in product_moves.get(self.product.id, []):
+            ref = REF()
+            ref.type_ = 'ON'
+            ref.origin = move
+            self.references += (ref,)
 
 
 class EdiShipmentInLineQty(ModelSQL, ModelView):
@@ -415,21 +538,14 @@ class EdiShipmentInLineQty(ModelSQL, ModelView):
         ('45E', '45E')],
         'Quantity Type', readonly=True)
     quantity = fields.Numeric('Quantity', readonly=True)
-    unit = fields.Selection([
-        (None, ''),
-        ('KGM', 'Kilogramo'),
-        ('GRM', 'Gramo'),
-        ('LTR', 'Litro'),
-        ('PCE', 'Pieza'),
-        ('EA', 'EA')],
-        'Unit', readonly=True)
+    unit = fields.Selection(UNITS, 'Unit', readonly=True)
     difference = fields.Selection([
         (None, ''),
         ('BP', 'Partial Shipment'),
         ('CP', 'Partial Shipment but Complete')],
         'Difference', readonly=True)
     edi_shipment_line = fields.Many2One('edi.shipment.in.line',
-        'Shipment Line', readonly=True)
+        'Shipment Line', readonly=True, ondelete='CASCADE')
 
 
 class EdiShipmentIn(Workflow, ModelSQL, ModelView):
@@ -457,12 +573,11 @@ class EdiShipmentIn(Workflow, ModelSQL, ModelView):
             },
         depends=['company'])
     shipment = fields.Many2One('stock.shipment.in', 'Shipment')
-    party = fields.Function(fields.Many2One('party.party', 'Shipment Party',
+    party = fields.Many2One('party.party', 'Shipment Party', readonly=True,
         context={
             'company': Eval('company'),
             },
-        depends=['company']),
-        'get_party', searcher='search_party')
+        depends=['company'])
     state = fields.Selection([
         ('draft', 'Draft'),
         ('confirmed', 'Confirmed'),
@@ -471,10 +586,42 @@ class EdiShipmentIn(Workflow, ModelSQL, ModelView):
     references_stock_moves = fields.Function(fields.One2Many(
         'stock.move', 'edi_shipment', "References Stock Moves",
         ), 'get_reference_stock_moves')
+    message_hash = fields.Char('Message Hash', readonly=True)
+    supplier_edi_code = fields.Char('Supplier EDI Code', readonly=True,
+        help='The EDI code of the NADSU supplier of the message.')
+    duplicate = fields.Boolean('Duplicate', readonly=True)
+    processing_note = fields.Text('Processing Note', readonly=True,
+        help='Why the EDI shipment was not processed automatically.')
+    # The classes of the records parsed from the DESADV files, modules can
+    # replace them by subclasses to read other segments
+    _desadv_message = desadv.Message
+    _desadv_line = desadv.Line
+    _desadv_supplier = desadv.Supplier
 
     @classmethod
     def __setup__(cls):
         super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.number, Index.Similarity())),
+                Index(t, (t.party, Index.Range())),
+                Index(t, (t.shipment, Index.Range())),
+                # The draft EDI shipments are listed by id
+                Index(
+                    t, (t.id, Index.Range()),
+                    where=t.state == 'draft'),
+                })
+        cls._sql_constraints += [
+            ('message_hash_exclude', Exclude(t, (t.message_hash, Equal),
+                    where=t.duplicate == Literal(False)),
+                'stock_shipment_in_edi.msg_duplicate_message'),
+            ('message_key_exclude', Exclude(t,
+                    (t.supplier_edi_code, Equal),
+                    (t.number, Equal),
+                    (t.function_, Equal),
+                    where=t.duplicate == Literal(False)),
+                'stock_shipment_in_edi.msg_duplicate_message'),
+            ]
         cls._transitions |= set((
                 ('draft', 'confirmed'),
                 ('confirmed', 'cancelled'),
@@ -502,6 +649,38 @@ class EdiShipmentIn(Workflow, ModelSQL, ModelView):
                 },
             })
 
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        SupplierEdi = pool.get('edi.shipment.supplier')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        supplier = SupplierEdi.__table__()
+        table_h = cls.__table_handler__(module_name)
+        party_exists = table_h.column_exist('party')
+        supplier_edi_code_exists = table_h.column_exist('supplier_edi_code')
+
+        super().__register__(module_name)
+
+        # Migration from 6.4: party is stored
+        if not party_exists:
+            cursor.execute(*table.update([table.party], [
+                        Coalesce(table.manual_party, supplier.select(
+                                supplier.party,
+                                where=(supplier.edi_shipment == table.id)
+                                & (supplier.type_ == 'NADSU'),
+                                order_by=[supplier.id.asc],
+                                limit=1))]))
+
+        # Migration from 6.4: add supplier_edi_code
+        if not supplier_edi_code_exists:
+            cursor.execute(*table.update([table.supplier_edi_code], [
+                        supplier.select(supplier.edi_code,
+                            where=(supplier.edi_shipment == table.id)
+                            & (supplier.type_ == 'NADSU'),
+                            order_by=[supplier.id.asc],
+                            limit=1)]))
+
     @staticmethod
     def default_company():
         return Transaction().context.get('company')
@@ -510,19 +689,43 @@ class EdiShipmentIn(Workflow, ModelSQL, ModelView):
     def default_state():
         return 'draft'
 
-    @classmethod
-    def search_party(cls, name, clause):
-        return ['OR', ('manual_party', ) + tuple(clause[1:]),
-                [('suppliers.type_', '=', 'NADSU'),
-                    ('suppliers.party', ) + tuple(clause[1:])]]
+    @staticmethod
+    def default_duplicate():
+        return False
 
-    def get_party(self, name):
+    def get_party(self):
         if self.manual_party:
             return self.manual_party.id
         for s in self.suppliers:
             if s.type_ == 'NADSU':
                 return s.party and s.party.id
 
+    @classmethod
+    def update_party(cls, edi_shipments):
+        'Store the manual party or the NADSU supplier party'
+        parties = defaultdict(list)
+        for edi_shipment in edi_shipments:
+            party = edi_shipment.get_party()
+            if (edi_shipment.party and edi_shipment.party.id) != party:
+                parties[party].append(edi_shipment)
+        if parties:
+            to_write = []
+            for party, records in parties.items():
+                to_write.extend((records, {'party': party}))
+            cls.write(*to_write)
+
+    @classmethod
+    def create(cls, vlist):
+        edi_shipments = super().create(vlist)
+        cls.update_party(edi_shipments)
+        return edi_shipments
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        edi_shipments = sum(args[0:None:2], [])
+        cls.update_party(cls.browse(edi_shipments))
+
     @classmethod
     @ModelView.button
     @Workflow.transition('cancelled')
@@ -541,208 +744,850 @@ class EdiShipmentIn(Workflow, ModelSQL, ModelView):
     def confirm(cls, edi_shipments):
         pass
 
-    def read_BGM(self, message):
-        self.number = message.pop(0) if message else ''
-        self.type_ = message.pop(0) if message else ''
-        self.function_ = message.pop(0) if message else ''
-
-    def read_DTM(self, message):
-        if message:
-            self.expedition_date = to_date(message.pop(0))
-        if message:
-            self.estimated_date = to_date(message.pop(0))
-
-    def read_RFF(self, message):
+    def get_product_moves(self):
+        'Return the moves of the referenced purchases grouped by product id'
         pool = Pool()
-        REF = pool.get('edi.shipment.in.reference')
-
-        ref = REF()
-        type_ = message.pop(0) if message else ''
-
-        ref.type_ = type_ if type_ in ('DQ', 'ON', 'LI', 'VN') else None
-
-        if message:
-            ref.reference = message.pop(0)
-        if message:
-            ref.reference_date = to_date(message.pop(0))
-        ref.search_reference()
-        if not getattr(self, 'references', False):
-            self.references = []
-        self.references += (ref,)
-
-    def read_TOD(self, message):
-        # Not implemented
-        pass
-
-    def read_TDT(self, message):
-        # Not implemented
-        pass
-
-    def read_CPS(self, message):
-        # Not implemented
-        pass
+        Purchase = pool.get('purchase.purchase')
 
-    def read_PAC(self, message):
-        # Not implemented
-        pass
+        product_moves = defaultdict(list)
+        for reference in self.references:
+            if (reference.type_ == 'ON'
+                    and isinstance(reference.origin, Purchase)):
+                for move in reference.origin.moves:
+                    product_moves[move.product.id].append(move)
+        return product_moves
 
-    def read_HAN(self, message):
-        # Not implemented
-        pass
+    def get_quantity(line):
+        if line.quantity is not None:
+            return float(line.quantity)
 
-    def read_PCI(self, message):
-        # Not implemented
-        pass
+    @classmethod
+    def get_reference_stock_moves(cls, edi_shipments, name):
+        '''Return the moves of the referenced purchases not in the lines
 
-    def read_ALI(self, message):
-        # Not implemented
-        pass
+        The moves of the lines that are not in the referenced purchases are
+        also returned.
+        '''
+        pool = Pool()
+        Reference = pool.get('edi.shipment.in.reference')
+        Move = pool.get('stock.move')
 
-    def read_CNTRES(self, message):
-        # Not implemented
-        pass
+        ids = [s.id for s in edi_shipments]
+        shipment_purchases = defaultdict(set)
+        line_moves = defaultdict(list)
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            for reference in Reference.search([
+                        ('edi_shipment', 'in', sub_ids),
+                        ('type_', '=', 'ON'),
+                        ('origin', 'like', 'purchase.purchase,%'),
+                        ]):
+                shipment_purchases[reference.edi_shipment.id].add(
+                    reference.origin.id)
+            for reference in Reference.search([
+                        ('edi_shipment_in_line.edi_shipment', 'in', sub_ids),
+                        ('type_', '=', 'ON'),
+                        ('origin', 'like', 'stock.move,%'),
+                        ], order=[('id', 'ASC')]):
+                line_moves[
+                    reference.edi_shipment_in_line.edi_shipment.id].append(
+                    reference.origin.id)
+
+        purchase_moves = defaultdict(list)
+        purchase_ids = set().union(*shipment_purchases.values())
+        for sub_ids in grouped_slice(purchase_ids):
+            for move in Move.search([
+                        ('origin.purchase', 'in', list(sub_ids),
+                            'purchase.line'),
+                        ], order=[('id', 'ASC')]):
+                purchase_moves[move.origin.purchase.id].append(move.id)
+
+        result = {}
+        for id_ in ids:
+            moves = dict.fromkeys(m for p in shipment_purchases[id_]
+                for m in purchase_moves[p])
+            # A move referenced by a line is fully received by it
+            for move_id in line_moves[id_]:
+                if move_id in moves:
+                    del moves[move_id]
+                else:
+                    moves[move_id] = None
+            result[id_] = list(moves)
+        return result
 
-    def read_MOA(self, message):
-        # Not implemented
-        pass
+    @classmethod
+    def get_desadv_classes(cls):
+        'Return the message, line and supplier classes of the parser'
+        return (cls._desadv_message, cls._desadv_line, cls._desadv_supplier)
 
-    def read_MEA(self, message):
-        # Not implemented
-        pass
+    @classmethod
+    def import_edi_file(cls, shipments, data):
+        '''Append the messages parsed from the DESADV lines to shipments
+
+        The messages are not EDI shipment records, they are created by
+        bulk_create.
+        '''
+        try:
+            shipments.extend(desadv.parse(
+                    data, classes=cls.get_desadv_classes()))
+        except desadv.UnknownSegmentError as exception:
+            raise UserError(gettext(
+                    'stock_shipment_in_edi.msg_unknown_segment',
+                    segment=exception.segment)) from exception
+        return shipments
 
-    def get_quantity(line):
-        for qty in line.quantities:
-            if qty.type_ == '12':
-                return float(qty.quantity)
+    @classmethod
+    def bulk_create(cls, messages):
+        '''Create the EDI shipments of the parsed messages
 
-    def get_reference_stock_moves(self, name=None):
+        The records of each model are created with a single call instead of
+        cascading through the One2Many fields record by record and are
+        returned in the same order as the messages.
+        '''
         pool = Pool()
-        Purchase = pool.get('purchase.purchase')
-        StockMove = pool.get('stock.move')
+        Line = pool.get('edi.shipment.in.line')
+        QTY = pool.get('edi.shipment.in.line.qty')
+        Reference = pool.get('edi.shipment.in.reference')
+        SupplierEdi = pool.get('edi.shipment.supplier')
 
-        purchase_moves = {}
+        def reference_values(reference):
+            values = reference.values()
+            if values.get('origin'):
+                values['origin'] = str(values['origin'])
+            return values
 
-        for reference in self.references:
-            if reference.type_ == 'ON' and reference.origin:
-                if isinstance(reference.origin, Purchase):
-                    for move in reference.origin.moves:
-                        purchase_moves[move.id] = move.quantity
+        if not messages:
+            return []
+        records = cls.create([m.values() for m in messages])
 
-        for line in self.lines:
+        suppliers, references, lines, parsed_lines = [], [], [], []
+        for record, message in zip(records, messages):
+            for parsed_supplier in message.suppliers:
+                supplier = SupplierEdi(**parsed_supplier.values())
+                supplier.search_party()
+                values = parsed_supplier.values()
+                values['party'] = supplier.party and supplier.party.id
+                values['edi_shipment'] = record.id
+                suppliers.append(values)
+            for reference in message.references:
+                values = reference_values(reference)
+                values['edi_shipment'] = record.id
+                references.append(values)
+            for line in message.lines:
+                values = line.values()
+                values['edi_shipment'] = record.id
+                lines.append(values)
+                parsed_lines.append(line)
+
+        quantities = []
+        for record, line in zip(Line.create(lines), parsed_lines):
+            for quantity in line.quantities:
+                values = quantity.values()
+                values['edi_shipment_line'] = record.id
+                quantities.append(values)
             for reference in line.references:
-                if reference.type_ == 'ON' and reference.origin:
-                    if isinstance(reference.origin, StockMove):
-                        move = reference.origin
-                        if move.id in purchase_moves:
-                            purchase_moves[move.id] = (
-                                purchase_moves[move.id] - move.quantity)
-                            if purchase_moves[move.id] <= 0:
-                                purchase_moves.pop(move.id)
-                        else:
-                            purchase_moves[move.id] = move.quantity
+                values = reference_values(reference)
+                values['edi_shipment_in_line'] = record.id
+                references.append(values)
+        if suppliers:
+            # It also stores the party of the EDI shipments
+            SupplierEdi.create(suppliers)
+        if quantities:
+            QTY.create(quantities)
+        if references:
+            Reference.create(references)
+        return records
 
-        return [x for x in purchase_moves]
+    @staticmethod
+    def get_duplicate_keys(edi_shipment):
+        '''Return the keys identifying the message of the EDI shipment
+
+        They are the message hash and the NADSU supplier code with the number
+        and the function, so a message resent with corrections is also
+        detected.
+        '''
+        keys = []
+        if edi_shipment.message_hash:
+            keys.append(edi_shipment.message_hash)
+        if edi_shipment.supplier_edi_code and edi_shipment.number:
+            keys.append((edi_shipment.supplier_edi_code, edi_shipment.number,
+                    edi_shipment.function_))
+        return keys
 
     @classmethod
-    def import_edi_file(cls, shipments, data):
+    def check_duplicates(cls, edi_shipments):
+        '''Return the EDI shipments to save
+
+        The messages already imported are skipped, replace the existing draft
+        ones or are flagged as duplicate depending on the configuration.
+        '''
         pool = Pool()
-        ShipmentEdi = pool.get('edi.shipment.in')
-        ShipmentEdiLine = pool.get('edi.shipment.in.line')
-        SupplierEdi = pool.get('edi.shipment.supplier')
-        # Configuration = pool.get('stock.configuration')
+        Configuration = pool.get('stock.configuration')
 
-        # config = Configuration(1)
-        separator = '|'  # TODO config.separator
+        policy = Configuration(1).edi_shipment_duplicate or 'skip'
+
+        existing = defaultdict(list)
+        hashes = {s.message_hash for s in edi_shipments if s.message_hash}
+        numbers = {s.number for s in edi_shipments
+            if s.supplier_edi_code and s.number}
+        found = {}
+        for name, values in [
+                ('message_hash', hashes), ('number', numbers)]:
+            for sub_values in grouped_slice(values):
+                for edi_shipment in cls.search([
+                            (name, 'in', list(sub_values)),
+                            ('duplicate', '=', False),
+                            ]):
+                    found[edi_shipment.id] = edi_shipment
+        for edi_shipment in found.values():
+            for key in cls.get_duplicate_keys(edi_shipment):
+                existing[key].append(edi_shipment)
 
-        shipment_edi = None
-        document_type = data.pop(0).replace('\n', '').replace('\r', '')
-        if document_type != 'DESADV_D_96A_UN_EAN005':
-            return
-        for line in data:
-            line = line.replace('\n', '').replace('\r', '')
-            line = line.split(separator)
-            msg_id = line.pop(0)
-            if msg_id == 'BGM':
-                shipment_edi = ShipmentEdi()
-                shipment_edi.read_BGM(line)
-            elif msg_id == 'LIN':
-                # if shipment_line:
-                #     shipment_line.search_related(shipment)
-                shipment_edi_line = ShipmentEdiLine()
-                shipment_edi_line.read_LIN(line)
-                if not getattr(shipment_edi, 'lines', False):
-                    shipment_edi.lines = []
-                shipment_edi.lines += (shipment_edi_line,)
-            elif 'LIN' in msg_id:
-                getattr(shipment_edi_line, 'read_%s' % msg_id)(line)
-            elif msg_id in [x[0] for x in SUPPLIER_TYPE]:
-                supplier = SupplierEdi()
-                getattr(supplier, 'read_%s' % msg_id)(line)
-                supplier.search_party()
-                if not getattr(shipment_edi, 'suppliers', False):
-                    shipment_edi.suppliers = []
-                shipment_edi.suppliers += (supplier,)
-            elif 'NAD' in msg_id:
+        to_save = []
+        # The keys of the EDI shipments to save
+        saving = {}
+        to_delete = []
+        for edi_shipment in edi_shipments:
+            keys = cls.get_duplicate_keys(edi_shipment)
+            duplicates = list(dict.fromkeys(
+                    d for k in keys for d in existing.get(k, [])))
+            previous = list(dict.fromkeys(
+                    saving[k] for k in keys if k in saving))
+            if not duplicates and not previous:
+                to_save.append(edi_shipment)
+                saving.update(dict.fromkeys(keys, edi_shipment))
+                continue
+            logger.info('Duplicate EDI shipment %s', edi_shipment.number)
+            if policy == 'skip':
                 continue
+            elif (policy == 'replace'
+                    and all(d.state == 'draft' and not d.shipment
+                        for d in duplicates)):
+                to_delete.extend(duplicates)
+                for duplicate in duplicates:
+                    for key in cls.get_duplicate_keys(duplicate):
+                        existing[key].remove(duplicate)
+                for message in previous:
+                    to_save.remove(message)
+                saving = {k: m for k, m in saving.items()
+                    if m not in previous}
+                to_save.append(edi_shipment)
+                saving.update(dict.fromkeys(keys, edi_shipment))
             else:
-                getattr(shipment_edi, 'read_%s' % msg_id)(line)
-
-        # invoice_line.search_related(shipment)
-        return shipment_edi
-
-    def add_attachment(self, attachment, filename=None):
+                edi_shipment.duplicate = True
+                to_save.append(edi_shipment)
+        if to_delete:
+            # The attachments are not deleted with their record
+            cls.purge(to_delete)
+        return to_save
+
+    def get_attachment(self, attachment, filename=None):
+        '''Return an unsaved attachment with the gzip compressed data
+
+        The data is stored in the filestore so identical files are only
+        stored once.
+        '''
         pool = Pool()
         Attachment = pool.get('ir.attachment')
 
         if not filename:
             filename = datetime.now().strftime("%y/%m/%d %H:%M:%S")
-        attach = Attachment(
-            name=filename,
+        if isinstance(attachment, str):
+            attachment = attachment.encode('utf-8')
+        return Attachment(
+            name=filename + '.gz',
             type='data',
-            data=attachment.decode('utf8'),
+            data=gzip.compress(attachment),
             resource=self)
-        attach.save()
+
+    def add_attachment(self, attachment, filename=None):
+        self.get_attachment(attachment, filename).save()
 
     @classmethod
     def import_shipment_in(cls, edi_shipments=None):
         pool = Pool()
         Configuration = pool.get('stock.configuration')
+        ImportRun = pool.get('edi.shipment.in.import_run')
+
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        # Prevent overlapping runs, the lock is released with the transaction
+        cursor.execute(*Select([transaction.database.lock_id(IMPORT_LOCK_ID)]))
+        locked, = cursor.fetchone()
+        if not locked:
+            logger.info('EDI shipment import already running')
+            return
 
         configuration = Configuration(1)
         source_path = os.path.abspath(configuration.inbox_path_edi or
              DEFAULT_FILES_LOCATION)
+        processing_path = os.path.join(source_path, PROCESSING_DIRECTORY)
+        os.makedirs(processing_path, exist_ok=True)
+
+        # Files left by an interrupted run are imported again
+        with os.scandir(processing_path) as entries:
+            files = [e.path for e in entries if e.is_file()]
+        for entry in cls.get_inbox_files(source_path):
+            filename = os.path.join(processing_path, claimed_name(entry.name))
+            try:
+                # The rename is atomic so a file is claimed only once
+                os.rename(entry.path, filename)
+            except FileNotFoundError:
+                continue
+            files.append(filename)
+        if not files:
+            return
 
-        files = [os.path.join(source_path, fp) for fp in
-                 os.listdir(source_path) if os.path.isfile(os.path.join(
-                     source_path, fp))]
-        files_to_delete = []
-        to_save = []
-        attachments = dict()
-        for fname in files:
-            if fname[-4:].lower() not in KNOWN_EXTENSIONS:
+        chunk_size = IMPORT_CHUNK_SIZE
+        if PARSE_PROCESSES > 1:
+            # The files of a chunk are parsed in parallel so a chunk must
+            # have enough files to use all the processes
+            chunk_size = max(chunk_size, PARSE_PROCESSES)
+        chunks = [files[i:i + chunk_size]
+            for i in range(0, len(files), chunk_size)]
+
+        start = datetime.now()
+        stats = ImportStats()
+        stats.count('files', len(files))
+        profiler, profile = None, None
+        if PROFILE_DIRECTORY:
+            # Only the calling thread is profiled
+            profiler = cProfile.Profile()
+            profiler.enable()
+        started = time.perf_counter()
+        import_files = partial(cls._import_files, transaction.database.name,
+            transaction.user, dict(transaction.context), stats=stats)
+        try:
+            if IMPORT_WORKERS > 1:
+                with ThreadPoolExecutor(
+                        max_workers=IMPORT_WORKERS) as executor:
+                    list(executor.map(import_files, chunks))
+            else:
+                for chunk in chunks:
+                    import_files(chunk)
+        finally:
+            if profiler:
+                profiler.disable()
+                os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+                profile = os.path.join(PROFILE_DIRECTORY,
+                    'edi_shipment_in_%s.prof' % start.strftime(
+                        '%Y%m%d%H%M%S%f'))
+                profiler.dump_stats(profile)
+        ImportRun.log(start, time.perf_counter() - started, stats, profile)
+
+    @staticmethod
+    def get_inbox_files(path):
+        '''Return the directory entries of the EDI files ready to be imported
+
+        Files modified during the last import_settle_time seconds are
+        skipped as they may still be being written.
+        '''
+        settled = time.time() - IMPORT_SETTLE_TIME
+        files = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # Extension and type are checked first as they do not need a
+                # stat call
+                if (entry.name[-4:].lower() not in KNOWN_EXTENSIONS
+                        or not entry.is_file()):
+                    continue
+                try:
+                    if entry.stat().st_mtime > settled:
+                        continue
+                except FileNotFoundError:
+                    continue
+                files.append(entry)
+        return files
+
+    @classmethod
+    def watch_inbox(cls):
+        '''Import the inbox files as soon as they are written
+
+        It never returns and uses inotify when inotify_simple is installed or
+        polls the inbox every watch_delay seconds otherwise. The transaction
+        of the caller is committed, the configuration is read again every
+        watch_configuration_delay seconds and each import is run in its own
+        transaction so none stays open while waiting. The cron can still be
+        used to sweep the inbox.
+        '''
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+
+        transaction = Transaction()
+        transaction.commit()
+
+        def get_source_path():
+            with transaction.new_transaction(readonly=True):
+                configuration = Configuration(1)
+                return os.path.abspath(configuration.inbox_path_edi or
+                     DEFAULT_FILES_LOCATION)
+
+        def is_edi_file(name):
+            return name[-4:].lower() in KNOWN_EXTENSIONS
+
+        def pending():
+            with os.scandir(source_path) as entries:
+                return any(is_edi_file(e.name) and e.is_file()
+                    for e in entries)
+
+        if INotify:
+            inotify = INotify()
+            watch = None
+
+            def watch_path():
+                nonlocal watch
+                if watch is not None:
+                    try:
+                        inotify.rm_watch(watch)
+                    except OSError:
+                        pass
+                watch = inotify.add_watch(
+                    source_path, flags.CLOSE_WRITE | flags.MOVED_TO)
+
+            def wait():
+                events = inotify.read(
+                    timeout=int(WATCH_CONFIGURATION_DELAY * 1000))
+                if not events:
+                    return False
+                # Let the rest of a burst of files arrive
+                time.sleep(WATCH_DELAY)
+                events += inotify.read(timeout=0)
+                return any(is_edi_file(e.name) for e in events)
+        else:
+            def watch_path():
+                pass
+
+            def wait():
+                time.sleep(WATCH_DELAY)
+                return pending()
+
+        source_path = None
+        checked = 0
+        while True:
+            try:
+                if time.monotonic() - checked >= WATCH_CONFIGURATION_DELAY:
+                    checked = time.monotonic()
+                    path = get_source_path()
+                    if path != source_path:
+                        logger.info('Watching the EDI inbox %s', path)
+                        source_path = path
+                        watch_path()
+                        # The files written before the watch are imported
+                        ready = pending()
+                    else:
+                        ready = wait()
+                else:
+                    ready = wait()
+            except Exception:
+                logger.exception('Error watching the EDI inbox')
+                # The inbox is watched again from scratch
+                source_path, checked = None, 0
+                time.sleep(WATCH_DELAY)
+                continue
+            if not ready:
+                continue
+            # The files not yet settled are left in the inbox by the import
+            # and their events are already consumed, so the inbox is imported
+            # again until it is empty
+            while True:
+                try:
+                    with transaction.new_transaction():
+                        cls.import_shipment_in()
+                except Exception:
+                    logger.exception('Error importing the EDI inbox')
+                if not pending():
+                    break
+                time.sleep(WATCH_DELAY)
+
+    @classmethod
+    def _import_files(cls, database_name, user, context, filenames,
+            stats=None):
+        '''Import the claimed files in their own transaction
+
+        Once committed the files are archived, the files that fail or do not
+        contain any message are moved to the error directory.
+        '''
+        if stats is None:
+            stats = ImportStats()
+        try:
+            with Transaction(new=True).start(database_name, user,
+                    context=context):
+                # The pool is only available once the transaction started
+                Configuration = Pool().get('stock.configuration')
+                # The counters are added only once the chunk is committed
+                chunk_stats = ImportStats()
+                imported, edi_shipment_ids = cls.import_files(
+                    filenames, chunk_stats)
+                auto_process = Configuration(1).edi_shipment_auto_process
+        except Exception:
+            if len(filenames) > 1:
+                for filename in filenames:
+                    cls._import_files(database_name, user, context,
+                        [filename], stats=stats)
+            else:
+                logger.exception('Error importing EDI file %s', filenames[0])
+                cls.move_file(filenames[0], ERROR_DIRECTORY,
+                    traceback.format_exc())
+                stats.count('failures')
+            return
+        stats.merge(chunk_stats)
+        for filename in filenames:
+            if filename in imported:
+                cls.move_file(filename, ARCHIVE_DIRECTORY)
+            else:
+                cls.move_file(filename, ERROR_DIRECTORY,
+                    'No DESADV message found')
+                stats.count('failures')
+        if auto_process and edi_shipment_ids:
+            cls._process_edi_shipments(database_name, user, context,
+                edi_shipment_ids, stats=stats)
+
+    @classmethod
+    def _process_edi_shipments(cls, database_name, user, context, ids,
+            stats=None):
+        '''Process the EDI shipments by batches in their own transaction
+
+        A failing batch is processed again one EDI shipment at a time and the
+        error of a failing EDI shipment is stored as its processing note.
+        '''
+        if stats is None:
+            stats = ImportStats()
+        for sub_ids in grouped_slice(ids, PROCESS_BATCH_SIZE):
+            sub_ids = list(sub_ids)
+            try:
+                with Transaction(new=True).start(database_name, user,
+                        context=context):
+                    batch_stats = ImportStats()
+                    cls.process_edi_shipments(
+                        cls.browse(sub_ids), batch_stats)
+            except Exception as exception:
+                if len(sub_ids) > 1:
+                    for id_ in sub_ids:
+                        cls._process_edi_shipments(database_name, user,
+                            context, [id_], stats=stats)
+                    continue
+                logger.exception(
+                    'Error processing EDI shipment %s', sub_ids[0])
+                with Transaction(new=True).start(database_name, user,
+                        context=context):
+                    cls.write(cls.browse(sub_ids), {
+                            'processing_note': str(exception),
+                            })
+                stats.count('skipped')
                 continue
-            with open(fname, 'r', encoding='latin-1') as fp:
-                data = fp.readlines()
-                shipment = cls.import_edi_file([], data)
+            stats.merge(batch_stats)
+
+    @classmethod
+    def process_edi_shipments(cls, edi_shipments, stats=None):
+        '''Create the shipment and confirm the matched EDI shipments
+
+        The EDI shipments that can not be processed are left in draft with
+        the reason as processing note.
+        Return the processed EDI shipments.
+        '''
+        if stats is None:
+            stats = ImportStats()
+
+        to_process, skipped = [], []
+        with stats.timer('process'):
+            for edi_shipment in edi_shipments:
+                if edi_shipment.state != 'draft' or edi_shipment.shipment:
+                    continue
+                reason = edi_shipment.get_process_skip_reason()
+                if reason:
+                    skipped.append((edi_shipment, reason))
+                else:
+                    to_process.append(edi_shipment)
+            if to_process:
+                cls.create_shipment(to_process)
+                cls.confirm(to_process)
+                cls.write(to_process, {'processing_note': None})
+            if skipped:
+                cls.write(*chain(*(([s], {'processing_note': r})
+                            for s, r in skipped)))
+        for edi_shipment, reason in skipped:
+            logger.info('EDI shipment %s not processed: %s',
+                edi_shipment.number, reason)
+        stats.count('processed', len(to_process))
+        stats.count('skipped', len(skipped))
+        return to_process
+
+    def get_process_skip_reason(self):
+        'Return why the EDI shipment can not be processed automatically'
+        if self.duplicate:
+            return gettext('stock_shipment_in_edi.msg_duplicate_message')
+        if not self.party:
+            return gettext('stock_shipment_in_edi.msg_no_party')
+        for reference in self.references:
+            if reference.type_ == 'ON' and not reference.origin:
+                return gettext('stock_shipment_in_edi.msg_no_purchase_ref')
+        if not self.lines:
+            return gettext('stock_shipment_in_edi.msg_no_lines')
+        for line in self.lines:
+            if not line.product:
+                return gettext('stock_shipment_in_edi.msg_no_product',
+                    number=line.line_number)
+            if (not line.references
+                    or not all(r.origin for r in line.references)):
+                return gettext('stock_shipment_in_edi.msg_no_move_ref',
+                    number=line.line_number)
 
-            basename = os.path.basename(fname)
-            if shipment:
-                attachments[shipment] = ("\n".join(data), basename)
-                to_save.append(shipment)
-                files_to_delete.append(fname)
+    @classmethod
+    def move_file(cls, filename, directory, error=None):
+        '''Move a claimed file to the directory of the inbox
+
+        If an error is given, it is written next to the file.
+        '''
+        inbox_path = os.path.dirname(os.path.dirname(filename))
+        path = os.path.join(inbox_path, directory)
+        os.makedirs(path, exist_ok=True)
+        name = os.path.basename(filename)
+        if os.path.exists(os.path.join(path, name)):
+            # Files claimed before they got a unique name
+            name = claimed_name(original_name(name))
+        new_filename = os.path.join(path, name)
+        os.rename(filename, new_filename)
+        if error:
+            with open(new_filename + '.error', 'w', encoding='utf-8') as fp:
+                fp.write(error)
 
-        if to_save:
-            cls.save(to_save)
+    @classmethod
+    def import_files(cls, filenames, stats=None):
+        '''Import the EDI files
+
+        Return the names of the imported files and the ids of the created EDI
+        shipments.
+
+        The files are not moved, this must be done once the transaction
+        is committed.
+        '''
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        Reference = pool.get('edi.shipment.in.reference')
+
+        if stats is None:
+            stats = ImportStats()
+
+        imported = []
+        messages = []
+        file_shipments = []
+        with stats.timer('parse'):
+            # The classes are pickled by reference for the parse processes
+            parse_file = partial(
+                desadv.parse_file, classes=cls.get_desadv_classes())
+            if PARSE_PROCESSES > 1 and len(filenames) > 1:
+                parsed = get_parse_executor().map(parse_file, filenames)
+            else:
+                parsed = map(parse_file, filenames)
+            for fname in filenames:
+                try:
+                    shipments = next(parsed)
+                except desadv.UnknownSegmentError as exception:
+                    raise UserError(gettext(
+                            'stock_shipment_in_edi.msg_unknown_segment',
+                            segment=exception.segment)) from exception
+
+                if shipments:
+                    messages.extend(shipments)
+                    imported.append(fname)
+                    file_shipments.append((fname, shipments))
+
+        with stats.timer('match'):
+            to_save = cls.check_duplicates(messages)
+            references = []
+            for shipment in to_save:
+                references.extend(shipment.references)
+                for line in shipment.lines:
+                    references.extend(line.references)
+            if references:
+                Reference.search_origins(references)
+        with stats.timer('save'):
+            created = dict(zip(map(id, to_save), cls.bulk_create(to_save)))
+
+        stats.count('messages', len(messages))
+        stats.count('segments', sum(m.segments for m in messages))
+        stats.count('lines', sum(len(m.lines) for m in messages))
+        stats.count('duplicates',
+            len(messages) - len([m for m in to_save if not m.duplicate]))
+        stats.count('records', len(to_save) + len(references) + sum(
+                len(m.suppliers) + len(m.lines)
+                + sum(len(line.quantities) for line in m.lines)
+                for m in to_save))
+        to_save = list(created.values())
+
+        attachments = []
+        with stats.timer('attachment'):
+            for fname, shipments in file_shipments:
+                shipments = [created[id(s)] for s in shipments
+                    if id(s) in created]
+                if not shipments:
+                    continue
+                # Read again once parsed to not keep the data during parsing
+                with open(fname, 'rb') as fp:
+                    data = fp.read()
+                attachment = shipments[0].get_attachment(
+                    data, original_name(fname))
+                attachments.append(attachment)
+                # The data is compressed once for all the messages of the
+                # file
+                attachments.extend(Attachment(name=attachment.name,
+                        type=attachment.type, data=attachment.data,
+                        resource=s)
+                    for s in shipments[1:])
+            if attachments:
+                with Transaction().set_user(0, set_context=True):
+                    Attachment.save(attachments)
+        stats.count('records', len(attachments))
+
+        with stats.timer('reference'):
+            # The origins of the references are set before their creation
+            cls.search_lines(to_save)
+        return imported, [s.id for s in to_save]
+
+    @classmethod
+    def purge_edi_shipments(cls):
+        '''Delete the confirmed and cancelled EDI shipments older than the
+        retention
+
+        The confirmed ones are kept until their shipment is done or
+        cancelled. Each batch is deleted in its own transaction to keep them
+        small and, if an archive path is set, exported before.
+        '''
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+
+        configuration = Configuration(1)
+        if not configuration.edi_shipment_retention:
+            return
+        archive_path = configuration.edi_shipment_archive_path
+        date = datetime.now() - configuration.edi_shipment_retention
+        domain = [
+            ('create_date', '<', date),
+            ['OR',
+                ('state', '=', 'cancelled'),
+                [
+                    ('state', '=', 'confirmed'),
+                    ['OR',
+                        ('shipment', '=', None),
+                        ('shipment.state', 'in', ['done', 'cancelled']),
+                        ],
+                    ],
+                ],
+            ]
+
+        transaction = Transaction()
+        while True:
+            filename = None
+            try:
+                with transaction.new_transaction():
+                    edi_shipments = cls.search(domain,
+                        order=[('id', 'ASC')], limit=PURGE_BATCH_SIZE)
+                    if not edi_shipments:
+                        break
+                    if archive_path:
+                        filename = cls.export_archive(
+                            edi_shipments, archive_path)
+                    cls.purge(edi_shipments)
+            except Exception:
+                if filename:
+                    os.remove(filename)
+                raise
+            if filename:
+                # The export is kept only once the batch is deleted
+                os.replace(filename, filename[:-len('.tmp')])
+            logger.info('Purged %s EDI shipments', len(edi_shipments))
+
+    @classmethod
+    def export_archive(cls, edi_shipments, path):
+        '''Export the EDI shipments to a gzip compressed JSON lines file
+
+        Each line contains the stored values of an EDI shipment with its
+        lines, quantities, references, suppliers and the base64 encoded
+        attachments of the original files. The file is written with a .tmp
+        suffix and its name is returned.
+        '''
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        Line = pool.get('edi.shipment.in.line')
+        QTY = pool.get('edi.shipment.in.line.qty')
+        Reference = pool.get('edi.shipment.in.reference')
+        SupplierEdi = pool.get('edi.shipment.supplier')
 
-        # with Transaction().set_user(0, set_context=True):
-        #     for shipment, (data, basename) in attachments.items():
-        #         shipment.add_attachment(data, basename)
+        def read(Model, field, ids):
+            'Read the stored values of the records whose field is in ids'
+            names = [n for n, f in Model._fields.items()
+                if not hasattr(f, 'set')
+                and f._type not in {'one2many', 'many2many'}]
+            values = []
+            for sub_ids in grouped_slice(ids):
+                records = Model.search([
+                        (field, 'in', list(sub_ids)),
+                        ], order=[('id', 'ASC')])
+                values.extend(Model.read([r.id for r in records], names))
+            return values
+
+        ids = [s.id for s in edi_shipments]
+        shipments = {v['id']: dict(v, lines=[], references=[], suppliers=[],
+                attachments=[])
+            for v in read(cls, 'id', ids)}
+        lines = {}
+        for values in read(Line, 'edi_shipment', ids):
+            lines[values['id']] = dict(values, quantities=[], references=[])
+            shipments[values['edi_shipment']]['lines'].append(
+                lines[values['id']])
+        # The line records are found through their EDI shipment so the
+        # domains do not grow with the number of lines
+        for values in read(QTY, 'edi_shipment_line.edi_shipment', ids):
+            lines[values['edi_shipment_line']]['quantities'].append(values)
+        for values in read(Reference, 'edi_shipment', ids):
+            if not values['edi_shipment_in_line']:
+                shipments[values['edi_shipment']]['references'].append(
+                    values)
+        for values in read(
+                Reference, 'edi_shipment_in_line.edi_shipment', ids):
+            lines[values['edi_shipment_in_line']]['references'].append(
+                values)
+        for values in read(SupplierEdi, 'edi_shipment', ids):
+            shipments[values['edi_shipment']]['suppliers'].append(values)
+        with Transaction().set_user(0, set_context=True):
+            for sub_shipments in grouped_slice(edi_shipments):
+                for attachment in Attachment.search([
+                            ('resource', 'in',
+                                [str(s) for s in sub_shipments]),
+                            ], order=[('id', 'ASC')]):
+                    shipments[attachment.resource.id]['attachments'].append({
+                            'name': attachment.name,
+                            'type': attachment.type,
+                            'data': (
+                                base64.b64encode(attachment.data).decode()
+                                if attachment.data else None),
+                            'link': attachment.link,
+                            'description': attachment.description,
+                            })
+
+        os.makedirs(path, exist_ok=True)
+        filename = os.path.join(path, 'edi_shipment_in_%s_%s.jsonl.gz.tmp' % (
+                datetime.now().strftime('%Y%m%d%H%M%S'), min(ids)))
+        with gzip.open(filename, 'wt', encoding='utf-8') as fp:
+            for values in shipments.values():
+                fp.write(json.dumps(values, default=str) + '\n')
+        return filename
 
-        if files_to_delete:
-            for file in files_to_delete:
-                os.remove(file)
+    @classmethod
+    def purge(cls, edi_shipments):
+        'Delete the EDI shipments with their attachments'
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
 
-        cls.search_references(to_save)
+        with Transaction().set_user(0, set_context=True):
+            attachments = []
+            for sub_shipments in grouped_slice(edi_shipments):
+                attachments.extend(Attachment.search([
+                            ('resource', 'in',
+                                [str(s) for s in sub_shipments]),
+                            ]))
+            Attachment.delete(attachments)
+        cls.delete(edi_shipments)
 
     def _get_new_lot(self, line, quantity):
         pool = Pool()
@@ -757,20 +1602,78 @@ class EdiShipmentIn(Workflow, ModelSQL, ModelView):
                 lot.number = line.lot_number
             return lot
 
+    @classmethod
+    def get_lots(cls, lines):
+        '''Return a dict with the lot of each line with expiration date
+
+        The lots with the same product, number and expiration date than a line
+        are searched at once and reused, the missing ones are created with a
+        single save.
+        '''
+        pool = Pool()
+
+        lines = [l for l in lines if l.expiration_date]
+        if not lines:
+            return {}
+        Lot = pool.get('stock.lot')
+
+        def key(line):
+            return (line.product.id, line.lot_number, line.expiration_date)
+
+        lots = {}
+        numbers = {l.lot_number for l in lines if l.lot_number}
+        products = {l.product.id for l in lines if l.lot_number}
+        for sub_numbers in grouped_slice(numbers):
+            for lot in Lot.search([
+                        ('number', 'in', list(sub_numbers)),
+                        ('product', 'in', list(products)),
+                        ]):
+                lots.setdefault(
+                    (lot.product.id, lot.number, lot.expiration_date), lot)
+
+        line2lot = {}
+        new_lots = []
+        for line in lines:
+            lot = lots.get(key(line)) if line.lot_number else None
+            if not lot:
+                lot = cls._get_new_lot(cls, line, cls.get_quantity(line))
+                new_lots.append(lot)
+                if line.lot_number:
+                    lots[key(line)] = lot
+            line2lot[line] = lot
+        if new_lots:
+            Lot.save(new_lots)
+        return line2lot
+
     @classmethod
     @ModelView.button
     def search_references(cls, edi_shipments):
+        pool = Pool()
+        Reference = pool.get('edi.shipment.in.reference')
+
+        edi_shipments = [s for s in edi_shipments if not s.shipment]
+        references = [r for s in edi_shipments for r in s.references]
+        Reference.search_origins(references)
+        Reference.save(references)
+        cls.search_lines(edi_shipments)
+
+    @classmethod
+    def search_lines(cls, edi_shipments):
+        '''Set the product and the purchase moves of the lines
+
+        The origins of the references of the EDI shipments must be already
+        set.
+        '''
         pool = Pool()
         Line = pool.get('edi.shipment.in.line')
 
-        to_save = []
+        lines = [l for s in edi_shipments for l in s.lines]
+        Line.search_products(lines)
         for edi_shipment in edi_shipments:
-            if edi_shipment.shipment:
-                continue
+            product_moves = edi_shipment.get_product_moves()
             for eline in edi_shipment.lines:
-                eline.search_related(edi_shipment)
-                to_save.append(eline)
-        Line.save(to_save)
+                eline.search_related(edi_shipment, product_moves)
+        Line.save(lines)
 
     @classmethod
     @ModelView.button
@@ -784,7 +1687,12 @@ class EdiShipmentIn(Workflow, ModelSQL, ModelView):
                 with_rec_name=False)
 
         to_save = []
+        edi_to_save = []
         move_to_save = []
+        # A move referenced by more than one line is assigned to the first
+        # one and copied for the others
+        used_moves = set()
+        to_copy = []
         for edi_shipment in edi_shipments:
             if edi_shipment.shipment:
                 continue
@@ -821,28 +1729,33 @@ class EdiShipmentIn(Workflow, ModelSQL, ModelView):
                         raise UserError(gettext(
                                 'stock_shipment_in_edi.msg_no_move_ref',
                                 number=line.line_number))
-                    if ref.origin not in move_to_save:
-                        quantity = cls.get_quantity(line)
-                        move = ref.origin
-                        move.shipment = shipment
-                        move.quantity = quantity
-                        move.lot = cls._get_new_lot(cls, line, quantity)
-                        move.planned_date = line.planned_date
-                        move_to_save.append(move)
+                    move = ref.origin
+                    if move.id not in used_moves:
+                        used_moves.add(move.id)
+                        move_to_save.append((move, shipment, line))
                     else:
-                        quantity = cls.get_quantity(line)
-                        move, = ref.origin.copy([ref.origin])
-                        move.shipment = shipment
-                        move.quantity = quantity
-                        move.lot = cls._get_new_lot(cls, line, quantity)
-                        move.planned_date = line.planned_date
-                        move_to_save.append(move)
-
-            edi_shipment.save()
+                        to_copy.append((move, shipment, line))
+
+            edi_to_save.append(edi_shipment)
             to_save.append(shipment)
 
+        if to_copy:
+            copies = Move.copy([m for m, _, _ in to_copy])
+            move_to_save.extend((c, s, l)
+                for c, (_, s, l) in zip(copies, to_copy))
+
         if to_save:
             ShipmentIn.save(to_save)
 
+        lots = cls.get_lots({l for _, _, l in move_to_save})
+        for move, shipment, line in move_to_save:
+            move.shipment = shipment
+            move.quantity = cls.get_quantity(line)
+            move.lot = lots.get(line)
+            move.planned_date = line.planned_date
+
         if move_to_save:
-            Move.save(move_to_save)
+            Move.save([m for m, _, _ in move_to_save])
+
+        if edi_to_save:
+            cls.save(edi_to_save)
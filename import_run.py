@@ -0,0 +1,107 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from trytond.model import fields, ModelSQL, ModelView
+
+logger = logging.getLogger(__name__)
+
+STAGES = ['parse', 'match', 'save', 'attachment', 'reference', 'process']
+COUNTERS = ['files', 'messages', 'segments', 'lines', 'records', 'duplicates',
+    'failures', 'processed', 'skipped']
+
+
+class ImportStats:
+    '''Timers and counters of an EDI shipment import run
+
+    It can be shared by the threads importing the chunks of the run.
+    '''
+
+    def __init__(self):
+        self.timers = defaultdict(float)
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timers[stage] += elapsed
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def merge(self, stats):
+        'Add the timers and counters of stats'
+        with self._lock:
+            for stage, elapsed in stats.timers.items():
+                self.timers[stage] += elapsed
+            self.counters.update(stats.counters)
+
+
+class EdiShipmentInImportRun(ModelSQL, ModelView):
+    'EDI Shipment In Import Run'
+    __name__ = 'edi.shipment.in.import_run'
+
+    start = fields.DateTime('Start', readonly=True)
+    duration = fields.TimeDelta('Duration', readonly=True)
+    parse_time = fields.TimeDelta('Parse Time', readonly=True,
+        help='Time spent reading and parsing the files.')
+    match_time = fields.TimeDelta('Match Time', readonly=True,
+        help='Time spent searching the duplicates and the references.')
+    save_time = fields.TimeDelta('Save Time', readonly=True,
+        help='Time spent searching the parties and creating the records.')
+    attachment_time = fields.TimeDelta('Attachment Time', readonly=True)
+    reference_time = fields.TimeDelta('Reference Time', readonly=True,
+        help='Time spent searching the products and the stock moves.')
+    process_time = fields.TimeDelta('Process Time', readonly=True,
+        help='Time spent creating and confirming the shipments.')
+    files = fields.Integer('Files', readonly=True)
+    messages = fields.Integer('Messages', readonly=True)
+    segments = fields.Integer('Segments', readonly=True)
+    lines = fields.Integer('Lines', readonly=True)
+    records = fields.Integer('Records', readonly=True,
+        help='Number of rows written.')
+    duplicates = fields.Integer('Duplicates', readonly=True)
+    failures = fields.Integer('Failures', readonly=True)
+    processed = fields.Integer('Processed', readonly=True,
+        help='Number of EDI shipments processed automatically.')
+    skipped = fields.Integer('Skipped', readonly=True,
+        help='Number of EDI shipments left for manual processing.')
+    profile = fields.Char('Profile', readonly=True,
+        help='The file where the profile of the run is dumped.')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('start', 'DESC'))
+
+    @classmethod
+    def log(cls, start, duration, stats, profile=None):
+        'Store and log the import run'
+        values = {
+            'start': start,
+            'duration': timedelta(seconds=duration),
+            'profile': profile,
+            }
+        for stage in STAGES:
+            values['%s_time' % stage] = timedelta(
+                seconds=stats.timers[stage])
+        for name in COUNTERS:
+            values[name] = stats.counters[name]
+        run, = cls.create([values])
+        logger.info('EDI shipment import of %s files in %.3fs (%s) (%s)',
+            stats.counters['files'], duration,
+            ', '.join('%s: %.3fs' % (s, stats.timers[s]) for s in STAGES),
+            ', '.join('%s: %s' % (n, stats.counters[n]) for n in COUNTERS))
+        return run
@@ -0,0 +1,22 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+
+class ProductIdentifier(metaclass=PoolMeta):
+    __name__ = 'product.identifier'
+
+    @classmethod
+    def create(cls, vlist):
+        Pool().get('edi.shipment.in.line')._product_cache.clear()
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Pool().get('edi.shipment.in.line')._product_cache.clear()
+        super().write(*args)
+
+    @classmethod
+    def delete(cls, identifiers):
+        Pool().get('edi.shipment.in.line')._product_cache.clear()
+        super().delete(identifiers)
@@ -14,6 +14,7 @@ PREFIX = 'nantic'
 MODULE2PREFIX = {
     'edocument_unedifact': 'nantic',
     'stock_scanner': 'nantic',
+    'stock_scanner_lot': 'nantic',
     'product_barcode': 'trytonzz',
     'party_edi': 'nantic',
     }
@@ -53,8 +54,13 @@ for dep in info.get('depends', []):
         prefix = MODULE2PREFIX.get(dep, 'trytond')
         requires.append(get_require_version('%s_%s' % (prefix, dep)))
 requires.append(get_require_version('trytond'))
+requires.append('PyYAML')
 
 tests_require = [get_require_version('proteus')]
+for dep in info.get('extras_depend', []):
+    if not re.match(r'(ir|res)(\W|$)', dep):
+        prefix = MODULE2PREFIX.get(dep, 'trytond')
+        tests_require.append(get_require_version('%s_%s' % (prefix, dep)))
 series = '%s.%s' % (major_version, minor_version)
 if minor_version % 2:
     branch = 'default'
@@ -112,7 +118,8 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         ],
     package_data={
         'trytond.modules.%s' % MODULE: (info.get('xml', [])
-            + ['tryton.cfg', 'locale/*.po', 'tests/*.rst']),
+            + ['tryton.cfg', 'locale/*.po', 'tests/*.rst',
+                'templates/*.yml']),
         },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
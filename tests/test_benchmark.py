@@ -0,0 +1,301 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.stock_shipment_in_edi import desadv
+from trytond.modules.stock_shipment_in_edi.tests.tools import (
+    ean13, generate_desadv)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import activate_module, drop_db, \
+    with_transaction
+
+BENCHMARK = os.environ.get('BENCHMARK')
+BASELINE = os.environ.get('BENCHMARK_BASELINE')
+OUTPUT = os.environ.get('BENCHMARK_OUTPUT')
+TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', 0.2))
+SHIPMENTS = int(os.environ.get('BENCHMARK_SHIPMENTS', 50))
+LINES = int(os.environ.get('BENCHMARK_LINES', 20))
+DUPLICATE_EANS = int(os.environ.get('BENCHMARK_DUPLICATE_EANS', 2))
+REPEAT = 5
+CONVERSIONS = int(os.environ.get('BENCHMARK_CONVERSIONS', 100000))
+# About 100k segments with a LIN, IMDLIN and QTYLIN per line
+FILE_LINES = int(os.environ.get('BENCHMARK_FILE_LINES', 33333))
+
+# Run in a new process so its peak RSS is only the one of the parsing
+MEMORY_SCRIPT = '''
+import resource
+import sys
+import time
+
+from trytond.modules.stock_shipment_in_edi import desadv
+
+filename, mode = sys.argv[1:]
+desadv.load_template()
+desadv.get_segment_dispatch()
+start = time.perf_counter()
+if mode == 'stream':
+    messages = desadv.parse_file(filename)
+elif mode == 'read':
+    with open(filename, encoding='latin-1') as fp:
+        messages = desadv.parse(fp.read().splitlines())
+else:
+    messages = []
+elapsed = time.perf_counter() - start
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def measure_parse(filename, mode):
+    'Return the parse time and the peak RSS in KiB of a new process'
+    output = subprocess.run([sys.executable, '-c', MEMORY_SCRIPT,
+            filename, mode], check=True, capture_output=True,
+        text=True).stdout
+    elapsed, rss = output.split()
+    return float(elapsed), int(rss)
+
+
+@unittest.skipUnless(BENCHMARK, 'BENCHMARK is not set')
+class StockShipmentInEdiBenchmarkTestCase(unittest.TestCase):
+    '''Benchmark StockShipmentInEdi module
+
+    The results are written to BENCHMARK_OUTPUT and checked against
+    the ones of BENCHMARK_BASELINE with a relative BENCHMARK_TOLERANCE.
+    '''
+    results = {}
+
+    @classmethod
+    def setUpClass(cls):
+        activate_module('stock_shipment_in_edi')
+        if BASELINE:
+            with open(BASELINE) as fp:
+                cls.baseline = json.load(fp)
+        else:
+            cls.baseline = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        drop_db()
+        if OUTPUT:
+            with open(OUTPUT, 'w') as fp:
+                json.dump(cls.results, fp, indent=4, sort_keys=True)
+
+    def record(self, name, value, higher_is_better=False):
+        'Store the result and check it against the baseline'
+        self.results[name] = value
+        if name not in self.baseline:
+            return
+        reference = self.baseline[name]
+        if higher_is_better:
+            self.assertGreaterEqual(value, reference * (1 - TOLERANCE),
+                msg='%s is slower than the baseline' % name)
+        else:
+            self.assertLessEqual(value, reference * (1 + TOLERANCE),
+                msg='%s is slower than the baseline' % name)
+
+    def setup_purchases(self, company):
+        'Create the products and the purchases with their moves'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+        Party = pool.get('party.party')
+        Location = pool.get('stock.location')
+        Purchase = pool.get('purchase.purchase')
+        Move = pool.get('stock.move')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        templates = Template.create([{
+                    'name': 'Product %s' % i,
+                    'type': 'goods',
+                    'default_uom': unit.id,
+                    'purchasable': True,
+                    'purchase_uom': unit.id,
+                    'products': [('create', [{
+                                    'identifiers': [('create', [{
+                                                    'type': 'ean',
+                                                    'code': ean13(i),
+                                                    }])],
+                                    }])],
+                    } for i in range(1, LINES + 1)])
+        products = [p for t in templates for p in t.products]
+        supplier, = Party.create([{'name': 'Supplier'}])
+        warehouse, = Location.search([('type', '=', 'warehouse')])
+        supplier_location, = Location.search([('type', '=', 'supplier')])
+
+        purchases = Purchase.create([{
+                    'company': company.id,
+                    'number': 'PO%05d' % i,
+                    'party': supplier.id,
+                    'currency': company.currency.id,
+                    'warehouse': warehouse.id,
+                    'lines': [('create', [{
+                                    'product': p.id,
+                                    'quantity': 10,
+                                    'unit': unit.id,
+                                    'unit_price': Decimal(1),
+                                    } for p in products])],
+                    } for i in range(1, SHIPMENTS + 1)])
+        Move.create([{
+                    'product': line.product.id,
+                    'uom': unit.id,
+                    'quantity': line.quantity,
+                    'from_location': supplier_location.id,
+                    'to_location': warehouse.input_location.id,
+                    'company': company.id,
+                    'unit_price': line.unit_price,
+                    'currency': company.currency.id,
+                    'origin': str(line),
+                    } for p in purchases for line in p.lines])
+        return supplier
+
+    def import_shipments(self, supplier):
+        'Create the EDI shipments of a synthetic file'
+        pool = Pool()
+        EdiShipmentIn = pool.get('edi.shipment.in')
+
+        messages = desadv.parse(generate_desadv(
+                shipments=SHIPMENTS, lines=LINES,
+                duplicate_eans=DUPLICATE_EANS).splitlines())
+        edi_shipments = EdiShipmentIn.bulk_create(messages)
+        EdiShipmentIn.write(edi_shipments, {'manual_party': supplier.id})
+        return edi_shipments
+
+    def test_parse(self):
+        'Benchmark parse throughput in segments per second'
+        data = generate_desadv(shipments=SHIPMENTS, lines=LINES,
+            references=3, suppliers=4,
+            duplicate_eans=DUPLICATE_EANS).splitlines()
+        # Cold conversion caches are part of the parsing cost
+        elapsed = []
+        for _ in range(REPEAT):
+            desadv.to_date.cache_clear()
+            desadv.to_decimal.cache_clear()
+            start = time.perf_counter()
+            messages = desadv.parse(data)
+            elapsed.append(time.perf_counter() - start)
+        segments = sum(m.segments for m in messages)
+
+        self.record('parse_segments_per_second', segments / min(elapsed),
+            higher_is_better=True)
+
+    def test_conversion(self):
+        'Benchmark date and decimal conversions per second'
+        # Files repeat a few dates and quantities
+        days = [date(2023, 1, 1) + timedelta(days=i % 60)
+            for i in range(CONVERSIONS)]
+        dates = [d.strftime(desadv.DATE_FORMAT) for d in days]
+        short_dates = [d.strftime(desadv.SHORT_DATE_FORMAT) for d in days]
+        quantities = [str(i % 50 + 1) for i in range(CONVERSIONS)]
+
+        def convert():
+            for value in dates:
+                desadv.to_date(value)
+            for value in short_dates:
+                desadv.to_date(value)
+            for value in quantities:
+                desadv.to_decimal(value, 4)
+
+        # The conversions done with strptime and a new quantizer each time
+        def convert_strptime():
+            for value in dates:
+                datetime.strptime(value, desadv.DATE_FORMAT)
+            for value in short_dates:
+                datetime.strptime(value, desadv.SHORT_DATE_FORMAT)
+            for value in quantities:
+                Decimal(value).quantize(Decimal('10')**-4)
+
+        elapsed = []
+        strptime_elapsed = []
+        for _ in range(REPEAT):
+            desadv.to_date.cache_clear()
+            desadv.to_decimal.cache_clear()
+            start = time.perf_counter()
+            convert()
+            elapsed.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            convert_strptime()
+            strptime_elapsed.append(time.perf_counter() - start)
+
+        self.assertEqual(desadv.to_date(dates[0]),
+            datetime.strptime(dates[0], desadv.DATE_FORMAT))
+        self.assertEqual(desadv.to_date(short_dates[0]),
+            datetime.strptime(short_dates[0], desadv.SHORT_DATE_FORMAT))
+        self.record('conversions_per_second',
+            3 * CONVERSIONS / min(elapsed), higher_is_better=True)
+        self.record('conversions_strptime_per_second',
+            3 * CONVERSIONS / min(strptime_elapsed), higher_is_better=True)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'),
+        'ru_maxrss is in KiB only on Linux')
+    def test_parse_memory(self):
+        'Benchmark parse time and peak RSS of a large file'
+        with tempfile.NamedTemporaryFile('w', suffix='.edi',
+                encoding='latin-1') as fp:
+            fp.write(generate_desadv(lines=FILE_LINES,
+                    duplicate_eans=DUPLICATE_EANS))
+            fp.flush()
+            _, base_rss = measure_parse(fp.name, 'none')
+            # Reading the whole file first is the way it was imported
+            read_time, read_rss = measure_parse(fp.name, 'read')
+            stream_time, stream_rss = measure_parse(fp.name, 'stream')
+
+        self.record('parse_file_read_seconds', read_time)
+        self.record('parse_file_read_rss_kib', read_rss - base_rss)
+        self.record('parse_file_seconds', stream_time)
+        self.record('parse_file_rss_kib', stream_rss - base_rss)
+
+    @with_transaction()
+    def test_matching(self):
+        'Benchmark matching time per line'
+        pool = Pool()
+        EdiShipmentIn = pool.get('edi.shipment.in')
+        Line = pool.get('edi.shipment.in.line')
+
+        company = create_company()
+        with set_company(company):
+            supplier = self.setup_purchases(company)
+            edi_shipments = self.import_shipments(supplier)
+            Line._product_cache.clear()
+
+            start = time.perf_counter()
+            EdiShipmentIn.search_references(edi_shipments)
+            elapsed = time.perf_counter() - start
+
+            for edi_shipment in edi_shipments:
+                for line in edi_shipment.lines:
+                    self.assertTrue(line.product)
+                    self.assertTrue(line.references)
+        self.record('matching_seconds_per_line',
+            elapsed / (SHIPMENTS * LINES))
+
+    @with_transaction()
+    def test_create_shipment(self):
+        'Benchmark create_shipment time per shipment'
+        pool = Pool()
+        EdiShipmentIn = pool.get('edi.shipment.in')
+
+        company = create_company()
+        with set_company(company):
+            supplier = self.setup_purchases(company)
+            edi_shipments = self.import_shipments(supplier)
+            EdiShipmentIn.search_references(edi_shipments)
+            edi_shipments = EdiShipmentIn.browse([s.id for s in edi_shipments])
+
+            start = time.perf_counter()
+            EdiShipmentIn.create_shipment(edi_shipments)
+            elapsed = time.perf_counter() - start
+
+            for edi_shipment in edi_shipments:
+                self.assertTrue(edi_shipment.shipment)
+                self.assertEqual(len(edi_shipment.shipment.incoming_moves),
+                    LINES)
+        self.record('create_shipment_seconds_per_shipment',
+            elapsed / SHIPMENTS)
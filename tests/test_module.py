@@ -1,14 +1,477 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime
+import os
+import tempfile
+import time
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+from trytond import backend
+from trytond.modules.company.tests import (CompanyTestMixin, create_company,
+    set_company)
+from trytond.modules.stock_shipment_in_edi import desadv, edi_shipment
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, DB_NAME, \
+    with_transaction
+from trytond.transaction import Transaction
+
+DESADV = '''DESADV_D_96A_UN_EAN005
+BGM|DES001|351|9
+DTM|20230115
+RFF|ON|PO001
+NADSU|8400000000017
+LIN|8400000000024|EN|1
+QTYLIN|12|10
+'''
+EAN = '8400000000024'
+EXPIRATION_DATE = datetime.date(2030, 12, 31)
+
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+class NoteLine(desadv.Line):
+    'Line that reads a segment unknown to the parser'
+    __slots__ = ('note',)
+    _internal = desadv.Line._internal + ('note',)
+
+    def read_NOTELIN(self, message):
+        self.note = message.pop(0) if message else ''
+
+
+def write_inbox_file(path, name, data):
+    'Write an EDI file in the inbox older than the settle time'
+    filename = os.path.join(path, name)
+    with open(filename, 'w', encoding='latin-1') as fp:
+        fp.write(data)
+    mtime = time.time() - 60
+    os.utime(filename, (mtime, mtime))
+    return filename
 
 
 class StockShipmentInEdiTestCase(CompanyTestMixin, ModuleTestCase):
     'Test StockShipmentInEdi module'
     module = 'stock_shipment_in_edi'
+    extras = ['stock_lot', 'stock_lot_sled']
+
+    def test_parse_desadv(self):
+        'Test parse DESADV'
+        message, = desadv.parse(DESADV.splitlines())
+
+        self.assertEqual(message.number, 'DES001')
+        self.assertEqual(
+            message.expedition_date, datetime.datetime(2023, 1, 15))
+        reference, = message.references
+        self.assertEqual((reference.type_, reference.reference),
+            ('ON', 'PO001'))
+        supplier, = message.suppliers
+        self.assertEqual(supplier.edi_code, '8400000000017')
+        line, = message.lines
+        self.assertEqual(line.code, '8400000000024')
+        self.assertEqual(line.quantity, Decimal('10'))
+
+    def test_parse_desadv_several_messages(self):
+        'Test parse DESADV with several messages'
+        # Batched files repeat the document header before each message
+        data = DESADV + DESADV.replace('DES001', 'DES002') + (
+            DESADV.replace('DES001', 'DES003').split('\n', 1)[1])
+        messages = desadv.parse(data.splitlines())
+
+        self.assertEqual([m.number for m in messages],
+            ['DES001', 'DES002', 'DES003'])
+        for message in messages:
+            line, = message.lines
+            self.assertEqual(line.quantity, Decimal('10'))
+            reference, = message.references
+            self.assertEqual(reference.reference, 'PO001')
+
+    def test_parse_desadv_hash(self):
+        'Test parse DESADV message hash ignores function'
+        message, = desadv.parse(DESADV.splitlines())
+        copy, = desadv.parse(
+            DESADV.replace('351|9', '351|31').splitlines())
+
+        self.assertEqual(message.message_hash, copy.message_hash)
+
+    def test_parse_desadv_unknown_segment(self):
+        'Test parse DESADV unknown segment'
+        with self.assertRaises(desadv.UnknownSegmentError):
+            desadv.parse((DESADV + 'XXX|1\n').splitlines())
+
+    def test_parse_desadv_classes(self):
+        'Test parse DESADV with extended classes'
+        data = (DESADV + 'NOTELIN|Fragile\n').splitlines()
+        with self.assertRaises(desadv.UnknownSegmentError):
+            desadv.parse(data)
+
+        message, = desadv.parse(data,
+            classes=(desadv.Message, NoteLine, desadv.Supplier))
+        line, = message.lines
+        self.assertEqual(line.note, 'Fragile')
+        self.assertEqual(line.quantity, Decimal('10'))
+        self.assertNotIn('note', line.values())
+
+    @with_transaction()
+    def test_search_products_supplier_code(self):
+        'Test search products by supplier code of the EDI shipment party'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+        Party = pool.get('party.party')
+        EdiShipmentIn = pool.get('edi.shipment.in')
+        Line = pool.get('edi.shipment.in.line')
+
+        # An unknown code so only the supplier code matches
+        data = DESADV.replace('LIN|%s|EN|1' % EAN,
+            'LIN|1234|EN|1\nPIALIN|IN|ART1')
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            supplier1, supplier2 = Party.create([
+                    {'name': 'Supplier 1'},
+                    {'name': 'Supplier 2'},
+                    ])
+            # Both suppliers use the same article number
+            template1, template2 = Template.create([{
+                        'name': 'Product %s' % supplier.name,
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'purchasable': True,
+                        'purchase_uom': unit.id,
+                        'products': [('create', [{}])],
+                        'product_suppliers': [('create', [{
+                                        'party': supplier.id,
+                                        'code': 'ART1',
+                                        }])],
+                        } for supplier in [supplier1, supplier2]])
+            product2, = template2.products
+            edi_shipment, = EdiShipmentIn.bulk_create(
+                desadv.parse(data.splitlines()))
+            EdiShipmentIn.write([edi_shipment], {'manual_party': supplier2.id})
+
+            line, = EdiShipmentIn(edi_shipment.id).lines
+            Line.search_products([line])
+            self.assertEqual(line.product, product2)
+
+            EdiShipmentIn.write([edi_shipment], {'manual_party': None})
+            line, = EdiShipmentIn(edi_shipment.id).lines
+            Line.search_products([line])
+            self.assertIsNone(getattr(line, 'product', None))
+
+    @with_transaction()
+    def test_check_duplicates(self):
+        'Test check duplicates with each policy'
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+        EdiShipmentIn = pool.get('edi.shipment.in')
+        Attachment = pool.get('ir.attachment')
+
+        company = create_company()
+        with set_company(company):
+            for policy in ['skip', 'replace', 'flag']:
+                with self.subTest(policy=policy):
+                    configuration = Configuration(1)
+                    configuration.edi_shipment_duplicate = policy
+                    configuration.save()
+                    data = DESADV.replace('DES001', policy).splitlines()
+                    existing, = EdiShipmentIn.bulk_create(desadv.parse(data))
+                    existing.add_attachment(DESADV, 'DESADV.EDI')
+
+                    to_save = EdiShipmentIn.check_duplicates(
+                        desadv.parse(data))
+                    edi_shipments = EdiShipmentIn.bulk_create(to_save)
+
+                    numbers = EdiShipmentIn.search([
+                            ('number', '=', policy),
+                            ])
+                    if policy == 'skip':
+                        self.assertEqual(edi_shipments, [])
+                        self.assertEqual(numbers, [existing])
+                    elif policy == 'replace':
+                        edi_shipment, = edi_shipments
+                        self.assertEqual(numbers, [edi_shipment])
+                        self.assertFalse(edi_shipment.duplicate)
+                        self.assertEqual(Attachment.search([
+                                    ('resource', '=', str(existing)),
+                                    ]), [])
+                    else:
+                        edi_shipment, = edi_shipments
+                        self.assertEqual(len(numbers), 2)
+                        self.assertTrue(edi_shipment.duplicate)
+                        self.assertFalse(existing.duplicate)
+
+    @with_transaction()
+    def test_check_duplicates_corrected(self):
+        'Test check duplicates detects a corrected message'
+        pool = Pool()
+        EdiShipmentIn = pool.get('edi.shipment.in')
+
+        company = create_company()
+        with set_company(company):
+            existing, = EdiShipmentIn.bulk_create(
+                desadv.parse(DESADV.splitlines()))
+            self.assertEqual(existing.supplier_edi_code, '8400000000017')
+
+            # The same supplier, number and function with another quantity
+            corrected = desadv.parse(
+                DESADV.replace('QTYLIN|12|10', 'QTYLIN|12|8').splitlines())
+            self.assertEqual(EdiShipmentIn.check_duplicates(corrected), [])
+            # Another supplier can use the same number
+            other = desadv.parse(
+                DESADV.replace('NADSU|8400000000017', 'NADSU|8400000000031')
+                .splitlines())
+            self.assertEqual(EdiShipmentIn.check_duplicates(other), other)
+
+    @with_transaction()
+    def test_check_duplicates_replace_processed(self):
+        'Test check duplicates does not replace processed EDI shipments'
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+        EdiShipmentIn = pool.get('edi.shipment.in')
+
+        company = create_company()
+        with set_company(company):
+            configuration = Configuration(1)
+            configuration.edi_shipment_duplicate = 'replace'
+            configuration.save()
+            existing, = EdiShipmentIn.bulk_create(
+                desadv.parse(DESADV.splitlines()))
+            EdiShipmentIn.confirm([existing])
+
+            edi_shipment, = EdiShipmentIn.check_duplicates(
+                desadv.parse(DESADV.splitlines()))
+
+            self.assertTrue(edi_shipment.duplicate)
+            self.assertEqual(EdiShipmentIn.search([]), [existing])
+
+    def create_purchase(self, company):
+        '''Create a product and a purchase PO001 of 10 units with its move
+
+        Return the supplier, the product and the move.
+        '''
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+        Party = pool.get('party.party')
+        Location = pool.get('stock.location')
+        Purchase = pool.get('purchase.purchase')
+        Move = pool.get('stock.move')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Product',
+                    'type': 'goods',
+                    'default_uom': unit.id,
+                    'purchasable': True,
+                    'purchase_uom': unit.id,
+                    'products': [('create', [{
+                                    'identifiers': [('create', [{
+                                                    'type': 'ean',
+                                                    'code': EAN,
+                                                    }])],
+                                    }])],
+                    }])
+        product, = template.products
+        supplier, = Party.create([{'name': 'Supplier'}])
+        warehouse, = Location.search([('type', '=', 'warehouse')])
+        supplier_location, = Location.search([('type', '=', 'supplier')])
+
+        purchase, = Purchase.create([{
+                    'company': company.id,
+                    'number': 'PO001',
+                    'party': supplier.id,
+                    'currency': company.currency.id,
+                    'warehouse': warehouse.id,
+                    'lines': [('create', [{
+                                    'product': product.id,
+                                    'quantity': 10,
+                                    'unit': unit.id,
+                                    'unit_price': Decimal(1),
+                                    }])],
+                    }])
+        line, = purchase.lines
+        move, = Move.create([{
+                    'product': product.id,
+                    'uom': unit.id,
+                    'quantity': line.quantity,
+                    'from_location': supplier_location.id,
+                    'to_location': warehouse.input_location.id,
+                    'company': company.id,
+                    'unit_price': line.unit_price,
+                    'currency': company.currency.id,
+                    'origin': str(line),
+                    }])
+        return supplier, product, move
+
+    @with_transaction()
+    def test_create_shipment_move_several_lines(self):
+        'Test create shipment with a move referenced by two lines'
+        pool = Pool()
+        EdiShipmentIn = pool.get('edi.shipment.in')
+
+        # Both lines have the same product and lot
+        lot = 'PCILIN|36E|%s||||||LOT1\n' % EXPIRATION_DATE.strftime(
+            '%Y%m%d')
+        data = (DESADV + lot + 'LIN|%s|EN|2\nQTYLIN|12|5\n' % EAN + lot)
+        company = create_company()
+        with set_company(company):
+            supplier, product, move = self.create_purchase(company)
+            edi_shipment, = EdiShipmentIn.bulk_create(
+                desadv.parse(data.splitlines()))
+            EdiShipmentIn.write([edi_shipment], {'manual_party': supplier.id})
+            EdiShipmentIn.search_references([edi_shipment])
+            edi_shipment = EdiShipmentIn(edi_shipment.id)
+
+            EdiShipmentIn.create_shipment([edi_shipment])
+
+            shipment = edi_shipment.shipment
+            self.assertEqual(shipment.supplier, supplier)
+            moves = sorted(shipment.incoming_moves, key=lambda m: m.quantity)
+            self.assertEqual([m.quantity for m in moves], [5, 10])
+            # The move is assigned to one line and copied for the other
+            self.assertIn(move, moves)
+            self.assertEqual({m.product for m in moves}, {product})
+            self.assertEqual(moves[0].lot, moves[1].lot)
+            self.assertEqual(moves[0].lot.number, 'LOT1')
+
+    @with_transaction()
+    def test_get_lots(self):
+        'Test get lots reuses the lots'
+        pool = Pool()
+        EdiShipmentIn = pool.get('edi.shipment.in')
+        Line = pool.get('edi.shipment.in.line')
+        Lot = pool.get('stock.lot')
+
+        company = create_company()
+        with set_company(company):
+            _, product, _ = self.create_purchase(company)
+            lot, = Lot.create([{
+                        'number': 'LOT1',
+                        'product': product.id,
+                        'expiration_date': EXPIRATION_DATE,
+                        }])
+            lines = [Line(product=product, lot_number=number,
+                    expiration_date=EXPIRATION_DATE, quantity=Decimal(1))
+                for number in ['LOT1', 'LOT2', 'LOT2']]
+            lines.append(Line(product=product, lot_number='LOT3',
+                    expiration_date=None, quantity=Decimal(1)))
+
+            line2lot = EdiShipmentIn.get_lots(lines)
+
+            self.assertEqual(line2lot[lines[0]], lot)
+            self.assertEqual(line2lot[lines[1]], line2lot[lines[2]])
+            self.assertEqual(line2lot[lines[1]].number, 'LOT2')
+            self.assertNotIn(lines[3], line2lot)
+            self.assertEqual(Lot.search([], count=True), 2)
+
+    @with_transaction()
+    def test_update_party(self):
+        'Test party of bulk created EDI shipments and manual party'
+        pool = Pool()
+        EdiShipmentIn = pool.get('edi.shipment.in')
+        SupplierEdi = pool.get('edi.shipment.supplier')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            supplier, manual = Party.create([
+                    {'name': 'Supplier'},
+                    {'name': 'Manual'},
+                    ])
+            edi_shipment, = EdiShipmentIn.bulk_create(
+                desadv.parse(DESADV.splitlines()))
+            edi_supplier, = edi_shipment.suppliers
+            self.assertEqual(edi_shipment.party, edi_supplier.party)
+
+            # The party is updated when the supplier party is set later
+            SupplierEdi.write([edi_supplier], {'party': supplier.id})
+            self.assertEqual(EdiShipmentIn(edi_shipment.id).party, supplier)
+
+            EdiShipmentIn.write([edi_shipment], {'manual_party': manual.id})
+            self.assertEqual(EdiShipmentIn(edi_shipment.id).party, manual)
+
+            EdiShipmentIn.write([edi_shipment], {'manual_party': None})
+            self.assertEqual(EdiShipmentIn(edi_shipment.id).party, supplier)
+
+    def setup_inbox(self, path):
+        '''Create a company and set the EDI inbox
+
+        They are committed as the files are imported in new transactions, so
+        the imported messages must use numbers of their own to not be
+        duplicates of the ones of the other tests.
+        '''
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+
+        company = create_company()
+        configuration = Configuration(1)
+        configuration.inbox_path_edi = path
+        configuration.save()
+        Transaction().commit()
+        return company
+
+    @unittest.skipIf(backend.name == 'sqlite' and DB_NAME == ':memory:',
+        'in-memory SQLite databases are not shared between threads')
+    @with_transaction()
+    def test_import_shipment_in_workers(self):
+        'Test import shipment in with 2 workers'
+        pool = Pool()
+        EdiShipmentIn = pool.get('edi.shipment.in')
+
+        with tempfile.TemporaryDirectory() as inbox, \
+                patch.object(edi_shipment, 'IMPORT_WORKERS', 2):
+            company = self.setup_inbox(inbox)
+            names = ['DESADV%s.EDI' % i for i in range(4)]
+            for i, name in enumerate(names):
+                write_inbox_file(inbox, name,
+                    DESADV.replace('DES001', 'WORKER%03d' % i))
+
+            with set_company(company):
+                EdiShipmentIn.import_shipment_in()
+
+                self.assertEqual(
+                    os.listdir(os.path.join(inbox, 'processing')), [])
+                self.assertEqual(
+                    len(os.listdir(os.path.join(inbox, 'archive'))), 4)
+                # The shipments are committed by the workers
+                with Transaction().new_transaction():
+                    self.assertEqual(EdiShipmentIn.search([
+                                ('number', 'in',
+                                    ['WORKER%03d' % i for i in range(4)]),
+                                ], count=True), 4)
+
+    @with_transaction()
+    def test_import_shipment_in(self):
+        'Test import shipment in archives good files and rejects bad ones'
+        pool = Pool()
+        EdiShipmentIn = pool.get('edi.shipment.in')
+        Attachment = pool.get('ir.attachment')
+
+        with tempfile.TemporaryDirectory() as inbox:
+            company = self.setup_inbox(inbox)
+            data = DESADV.replace('DES001', 'INBOX001')
+            write_inbox_file(inbox, 'GOOD.EDI', data)
+            write_inbox_file(inbox, 'BAD.EDI', data + 'XXX|1\n')
+
+            with set_company(company):
+                EdiShipmentIn.import_shipment_in()
+
+                self.assertEqual(
+                    os.listdir(os.path.join(inbox, 'processing')), [])
+                archived, = os.listdir(os.path.join(inbox, 'archive'))
+                self.assertEqual(
+                    edi_shipment.original_name(archived), 'GOOD.EDI')
+                error, message = sorted(
+                    os.listdir(os.path.join(inbox, 'error')))
+                self.assertEqual(edi_shipment.original_name(error), 'BAD.EDI')
+                self.assertEqual(message, error + '.error')
+                with Transaction().new_transaction():
+                    imported, = EdiShipmentIn.search([
+                            ('number', '=', 'INBOX001'),
+                            ])
+                    attachment, = Attachment.search([
+                            ('resource', '=', str(imported)),
+                            ])
+                    self.assertEqual(attachment.name, 'GOOD.EDI.gz')
 
 
 del ModuleTestCase
@@ -0,0 +1,41 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from stdnum import ean
+
+SUPPLIER_TYPES = ['NADSU', 'NADBY', 'NADDP', 'NADMS']
+
+
+def ean13(number):
+    'Return a valid EAN-13 code for the number'
+    code = '%012d' % number
+    return code + ean.calc_check_digit(code)
+
+
+def generate_desadv(shipments=1, lines=10, references=1, suppliers=1,
+        duplicate_eans=0, first_product=1):
+    '''Return the content of a synthetic DESADV file
+
+    Each shipment references the purchase PO<shipment number> and has lines
+    for the products with EAN ean13(first_product + line index). The last
+    duplicate_eans lines of each shipment repeat the EAN of the first ones.
+    '''
+    segments = ['DESADV_D_96A_UN_EAN005']
+    for number in range(1, shipments + 1):
+        segments.append('BGM|DES%05d|351|9' % number)
+        segments.append('DTM|20230115|20230117')
+        segments.append('RFF|ON|PO%05d|20230110' % number)
+        for reference in range(1, references):
+            segments.append('RFF|DQ|ALB%05d-%d' % (number, reference))
+        for supplier in range(suppliers):
+            segments.append('%s|%s' % (
+                    SUPPLIER_TYPES[supplier % len(SUPPLIER_TYPES)],
+                    ean13(900000000 + supplier)))
+        for line in range(lines):
+            if line >= lines - duplicate_eans:
+                product = first_product + line - (lines - duplicate_eans)
+            else:
+                product = first_product + line
+            segments.append('LIN|%s|EN|%s' % (ean13(product), line + 1))
+            segments.append('IMDLIN|F|Product %s' % product)
+            segments.append('QTYLIN|12|%s' % (line % 5 + 1))
+    return '\n'.join(segments) + '\n'